@@ -0,0 +1,45 @@
+"""
+    Times the lookup of the active session through db.sess, the path every
+    MethodsMixin helper takes, inside and outside of a request.
+
+        python scripts/bench-sess-lookup.py [profile]
+"""
+from __future__ import print_function
+
+import sys
+import timeit
+
+from blazeweb.testing import inrequest
+
+from sqlalchemybwc import db
+from sqlalchemybwc_ta.application import make_wsgi
+
+NUMBER = 200000
+
+
+def bench(label, stmt):
+    best = min(timeit.repeat(stmt, number=NUMBER, repeat=5))
+    print('%-30s %6.0f ns per lookup' % (label, best / NUMBER * 1e9))
+
+
+def main(profile):
+    make_wsgi(profile)
+    # the app has to exist before the models can be imported
+    from sqlalchemybwc_ta.model.orm import Car
+
+    bench('db.sess', lambda: db.sess)
+    bench('Car._sa_sess()', Car._sa_sess)
+
+    @inrequest()
+    def in_request():
+        # as SQLAlchemyApp does for each request
+        db.begin_request()
+        bench('db.sess (in request)', lambda: db.sess)
+        bench('Car._sa_sess() (in request)', Car._sa_sess)
+    in_request()
+
+
+if __name__ == '__main__':
+    for profile in sys.argv[1:] or ['Test', 'SplitSessionsTest']:
+        print(profile)
+        main(profile)
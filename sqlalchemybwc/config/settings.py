@@ -9,3 +9,57 @@ class Settings(ComponentSettings):
         # objects returned from a session don't lose their session the next
         # time a request is ran through WSGI in functional testing.
         self.for_me.use_split_sessions = False
+        # collect statistics about the statements each request executes.  They
+        # are available in environ['sqlalchemybwc.query_stats'] and are sent
+        # with the 'sqlalchemybwc.request.query_stats' signal at the end of the
+        # response cycle, for logging or metrics.
+        self.for_me.instrument_queries = False
+        # the number of slowest statements to keep per request
+        self.for_me.instrument_slowest = 5
+        # report possible N+1 query problems: a SELECT executed more than this
+        # many times in one request, usually a relationship lazy loading
+        # inside a loop.  None disables the check.
+        self.for_me.nplusone_threshold = None
+        # what to do with them: 'log' a warning, 'raise' NPlusOneError (for
+        # testing) or add an X-Repeated-Queries 'header' to the response with
+        # the number of repeated statements
+        self.for_me.nplusone_action = 'log'
+        # report statements taking this many seconds or longer, with their bind
+        # values and the calling code.  None disables the slow query log.
+        self.for_me.slow_query_threshold = None
+        # capture the plan of slow SELECTs: EXPLAIN ANALYZE on postgresql,
+        # EXPLAIN QUERY PLAN on sqlite and EXPLAIN on mysql
+        self.for_me.slow_query_explain = False
+        # slow queries are logged as warnings to the "sqlalchemybwc.slow_queries"
+        # logger, and to this rotating file when set...
+        self.for_me.slow_query_log_file = None
+        # ...unless this callable is set, which gets a SlowQuery instead
+        self.for_me.slow_query_callback = None
+        # connection pool settings for dialects using a QueuePool (not SQLite).
+        # None leaves SQLAlchemy's default, except for pool_recycle on MySQL
+        # which defaults to an hour.  Pool options set in settings.db win.
+        self.for_me.pool_size = None
+        self.for_me.pool_max_overflow = None
+        # seconds to wait for a connection before giving up
+        self.for_me.pool_timeout = None
+        # seconds after which a connection is replaced with a new one
+        self.for_me.pool_recycle = None
+        # test connections with "SELECT 1" when they are checked out of the
+        # pool and replace the ones the DB server has dropped
+        self.for_me.pool_pre_ping = False
+        # connections to open when the engine is created, and again in each
+        # process forked after that, so a new worker is ready for requests.
+        # Before Python 3.7, a worker only does this on first use unless the
+        # server calls db.after_fork() after forking it.
+        self.for_me.pool_warm_up = 0
+        # keep statistics about the pool's connections and checkout latency in
+        # db.pool_stats
+        self.for_me.pool_stats = False
+        # with settings.db.replica_urls, a list of read replica URLs, plain
+        # SELECTs go to a replica until the session writes.  'round_robin' or
+        # 'least_connections'
+        self.for_me.replica_strategy = 'round_robin'
+        # import the model modules on the first request, instead of when the
+        # WSGI stack is built, for faster worker startup.  Code that needs the
+        # models outside of a request should call db.load_models() first.
+        self.for_me.lazy_visit_mods = False
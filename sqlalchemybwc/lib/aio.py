@@ -0,0 +1,201 @@
+"""
+    Awaitable DB access for asyncio code.
+
+    SQLAlchemy has no asyncio support, so the work is still done by threads,
+    but AsyncContainer takes care of what makes that hard to get right: each
+    asyncio task gets one session, used by every call the task makes no matter
+    which worker thread runs it, `db` points at the task's session while the
+    call runs, and the session is removed when the task is done.  A session
+    is not thread safe, so the calls of a task run one after another even when
+    it has several in flight, e.g. with asyncio.gather().  Calls made outside
+    of a task each get a session of their own.
+
+        adb = AsyncContainer(db._current_obj())
+        acar = adb.model(Car)
+
+        async def handler(car_id):
+            car = await acar.get(car_id)
+            cars = await acar.list_where(Car.year > 2010)
+            await adb.transaction(change_cars)(cars)
+            return car.to_dict()
+
+    Instances are attached to the task's session, so lazy loading their
+    relationships from the event loop runs SQL in the loop's thread.  Load what
+    is needed inside the call instead.
+"""
+import functools
+import itertools
+import threading
+import weakref
+
+try:
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    asyncio = None
+
+from compstack.sqlalchemy import db
+from compstack.sqlalchemy.lib.decorators import transaction_ncm
+from compstack.sqlalchemy.lib.middleware import SessionView
+
+
+def _current_task():
+    if hasattr(asyncio, 'current_task'):
+        try:
+            return asyncio.current_task()
+        except RuntimeError:
+            # no running event loop
+            return None
+    return asyncio.Task.current_task()
+
+
+class AsyncContainer(object):
+    """
+        container: the SQLAlchemyContainer to use
+        max_workers: threads available for DB calls, at most one connection
+            each.  Ignored when an executor is given.
+    """
+    def __init__(self, container, max_workers=10, executor=None):
+        if asyncio is None:
+            raise ImportError('AsyncContainer requires asyncio (Python 3.4+)')
+        self.container = container
+        self.executor = executor or ThreadPoolExecutor(max_workers)
+        self._local = threading.local()
+        self._scopes = weakref.WeakKeyDictionary()
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._session = None
+        # scope -> Future done when the last call submitted for it has run,
+        # only used on the loop's thread
+        self._last_calls = {}
+
+    @property
+    def Session(self):
+        """ a scoped session with one session per task """
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    self._session = self.container.make_session(scopefunc=self._scope)
+        return self._session
+
+    def _scope(self):
+        try:
+            return self._local.scope
+        except AttributeError:
+            raise RuntimeError('the task session is only available inside AsyncContainer.run()')
+
+    def _call(self, scope, fn, args, kwargs, remove=False):
+        # in the worker thread
+        self._local.scope = scope
+        task_container = SessionView(self.container, self.Session)
+        db._push_object(task_container)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            db._pop_object(task_container)
+            if remove:
+                self.Session.remove()
+            del self._local.scope
+
+    def _task_scope(self):
+        task = _current_task()
+        if task is None:
+            return None
+        if task not in self._scopes:
+            self._scopes[task] = (next(self._counter), asyncio.get_event_loop())
+            task.add_done_callback(self._task_done)
+        return self._scopes[task][0]
+
+    def _task_done(self, task):
+        scope, loop = self._scopes.pop(task, (None, None))
+        if scope is not None:
+            # after any call of the task still in flight
+            self._submit(loop, scope, self.Session.remove, (), {})
+
+    def _submit(self, loop, scope, fn, args, kwargs, remove=False):
+        """
+            Runs the call in the executor once the previous call for the
+            scope is done and returns a Future for its result.
+        """
+        result = asyncio.Future(loop=loop)
+        # not `result`, which can be cancelled while the call still runs
+        ran = asyncio.Future(loop=loop)
+        previous = self._last_calls.get(scope)
+        self._last_calls[scope] = ran
+
+        def copy_result(future):
+            ran.set_result(None)
+            if self._last_calls.get(scope) is ran:
+                del self._last_calls[scope]
+            if result.cancelled():
+                return
+            if future.cancelled():
+                result.cancel()
+            elif future.exception() is not None:
+                result.set_exception(future.exception())
+            else:
+                result.set_result(future.result())
+
+        def start(_=None):
+            future = loop.run_in_executor(self.executor, self._call, scope, fn, args, kwargs,
+                                          remove)
+            future.add_done_callback(copy_result)
+
+        if previous is None:
+            start()
+        else:
+            previous.add_done_callback(start)
+        return result
+
+    def run(self, fn, *args, **kwargs):
+        """
+            Calls fn(*args, **kwargs) in a worker thread using the current
+            task's session and returns an awaitable for the result.
+        """
+        loop = asyncio.get_event_loop()
+        scope = self._task_scope()
+        if scope is None:
+            # not in a task, the session lives for this call only
+            return self._submit(loop, next(self._counter), fn, args, kwargs, remove=True)
+        return self._submit(loop, scope, fn, args, kwargs)
+
+    def transaction(self, fn):
+        """
+            The awaitable version of @transaction: returns a function that runs
+            `fn` in a transaction committed when it returns and rolled back if
+            it raises.
+        """
+        fn = transaction_ncm(fn)
+
+        @functools.wraps(fn)
+        def run_transaction(*args, **kwargs):
+            return self.run(fn, *args, **kwargs)
+        return run_transaction
+
+    def model(self, entity_class):
+        """ awaitable versions of the class's methods, like the MethodsMixin helpers """
+        return AsyncModel(self, entity_class)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait)
+
+
+class AsyncModel(object):
+    """
+        Wraps an entity class so its methods return awaitables:
+
+            car = await adb.model(Car).get_by(make='ford')
+    """
+    def __init__(self, async_container, entity_class):
+        self.async_container = async_container
+        self.entity_class = entity_class
+
+    def __getattr__(self, name):
+        method = getattr(self.entity_class, name)
+        if not callable(method):
+            return method
+
+        @functools.wraps(method)
+        def run_method(*args, **kwargs):
+            return self.async_container.run(method, *args, **kwargs)
+        return run_method
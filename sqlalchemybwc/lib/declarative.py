@@ -1,4 +1,7 @@
+from collections import OrderedDict
 from datetime import datetime
+import operator
+import time
 
 from blazeutils.helpers import tolist
 from blazeutils.strings import randchars
@@ -6,6 +9,7 @@ from blazeweb.globals import ag
 import savalidation as saval
 import six
 import sqlalchemy as sa
+from sqlalchemy.ext import baked
 import sqlalchemy.ext.declarative as sadec
 from sqlalchemy.inspection import inspect as sa_inspect
 import sqlalchemy.orm as saorm
@@ -15,6 +19,77 @@ from compstack.sqlalchemy import db
 from compstack.sqlalchemy.lib.columns import SmallIntBool
 from compstack.sqlalchemy.lib.decorators import one_to_none, transaction, \
     ignore_unique
+from compstack.sqlalchemy.lib.helpers import max_bind_params
+from compstack.sqlalchemy.lib.pagination import decode_cursor, encode_cursor, order_columns, \
+    Page, seek_clause
+from compstack.sqlalchemy.lib.upsert import Upsert
+
+
+# cache of the queries built by MethodsMixin's *_by() helpers
+_bakery = baked.bakery()
+
+# mapped class -> its MapperInfo.  A plain dict: the info holds the class, its
+# mapper and attributes, so a weak key would never be dropped anyway.
+_mapper_info = {}
+
+# mm_load= strategy -> loader option.  SQLAlchemy < 1.2 has no selectinload(),
+# subqueryload() also loads the relationship for all parent rows in one query.
+_loader_options = {
+    'joined': 'joinedload',
+    'subquery': 'subqueryload',
+    'selectin': 'selectinload' if hasattr(saorm, 'selectinload') else 'subqueryload',
+}
+
+
+def _chunked(iterable, size):
+    """
+        yields lists of at most `size` items from `iterable`
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class MapperInfo(object):
+    """
+        The introspection of a mapped class that MethodsMixin's helpers need,
+        done once, after the mappers are configured, instead of on every call.
+
+            column_names: keys of the column properties
+            column_keys: dict of column property key -> table column key
+            pk_cols: the primary key columns
+            pk_keys: keys of the primary key properties
+            relationships: dict of relationship key -> target class
+            single_table_criterion: the discriminator clause of a single table
+                inheritance subclass, otherwise None
+
+        Properties added to the mapper after the info is built are not seen.
+    """
+    def __init__(self, cls):
+        saorm.configure_mappers()
+        mapper = sa_inspect(cls)
+        self.cls = cls
+        self.mapper = mapper
+        self.column_names = tuple(prop.key for prop in mapper.column_attrs)
+        self.column_keys = dict((prop.key, prop.columns[0].key) for prop in mapper.column_attrs)
+        self.pk_cols = tuple(mapper.primary_key)
+        self.pk_keys = tuple(mapper.get_property_by_column(col).key for col in self.pk_cols)
+        self.relationships = dict((prop.key, prop.mapper.class_) for prop in mapper.relationships)
+        self.single_table_criterion = mapper._single_table_criterion
+        self._attrs = {}
+
+    def attr(self, name):
+        """ the class attribute `name`, e.g. to give to query() """
+        try:
+            return self._attrs[name]
+        except KeyError:
+            attr = self._attrs[name] = getattr(self.cls, name)
+            return attr
 
 
 class DefaultColsMixin(object):
@@ -29,6 +104,10 @@ class MethodsMixin(object):
     mm_db_global = db
     # the name of the attribute representing the SA session
     mm_db_sess_attr = 'sess'
+    # relationships the read helpers load eagerly when not given mm_load=
+    mm_eager_load = ()
+    # the strategy for relationships given to mm_load= without one
+    mm_eager_strategy = 'selectin'
 
     @classmethod
     def _sa_sess(cls):
@@ -37,7 +116,8 @@ class MethodsMixin(object):
     @classmethod
     def query(cls, *args):
         if args:
-            entities = [getattr(cls, aname) for aname in args]
+            info = cls._sa_info()
+            entities = [info.attr(aname) for aname in args]
         else:
             entities = [cls]
         return cls._sa_sess().query(*entities)
@@ -49,6 +129,41 @@ class MethodsMixin(object):
         cls._sa_sess().add(o)
         return o
 
+    @transaction
+    def add_many(cls, rows, chunk_size=1000, return_pks=False):
+        """
+            Inserts many records in a single transaction using chunked
+            executemany INSERTs instead of one flush and commit per record.
+
+            rows: iterable of dicts keyed by attribute name
+            chunk_size: the number of rows sent to the DB in each executemany
+            return_pks: when True, a list of the new primary keys (in the
+                order of `rows`) is returned.  The keys have to be fetched
+                for each row, so the INSERTs are sent one at a time, but
+                still within the single transaction.
+
+            No instances are created, so from_dict(), validation and ORM
+            events are skipped for these rows.  Column defaults are applied.
+
+            Returns the number of rows inserted or the list of primary keys.
+        """
+        sess = cls._sa_sess()
+        pk_keys = cls._sa_pk_keys()
+        count = 0
+        pks = []
+        for chunk in _chunked(rows, chunk_size):
+            # copy the rows, bulk_insert_mappings() writes the defaults back into them
+            chunk = [dict(row) for row in chunk]
+            sess.bulk_insert_mappings(cls, chunk, return_defaults=return_pks)
+            count += len(chunk)
+            if return_pks:
+                for row in chunk:
+                    pk = tuple(row[key] for key in pk_keys)
+                    pks.append(pk[0] if len(pk) == 1 else pk)
+        if return_pks:
+            return pks
+        return count
+
     @ignore_unique
     def add_iu(cls, **kwargs):
         """
@@ -67,6 +182,56 @@ class MethodsMixin(object):
         o.from_dict(kwargs)
         return o
 
+    @transaction
+    def edit_many(cls, rows, chunk_size=1000):
+        """
+            Updates many records in a single transaction using chunked
+            executemany UPDATEs.  The records are not SELECTed first.
+
+            rows: iterable of dicts keyed by attribute name, each of which must
+                include the primary key of the record to update
+            chunk_size: the number of rows sent to the DB in each executemany
+
+            Instances already in the session's identity map have the updated
+            attributes expired, so they are reloaded on their next access.
+            Validation and ORM events are skipped for these rows.
+
+            Returns the number of rows given.
+        """
+        sess = cls._sa_sess()
+        info = cls._sa_info()
+        mapper = info.mapper
+        pk_keys = info.pk_keys
+        count = 0
+        for chunk in _chunked(rows, chunk_size):
+            for row in chunk:
+                if [key for key in pk_keys if row.get(key) is None]:
+                    raise ValueError('the primary key must be given to edit a record')
+            sess.bulk_update_mappings(cls, chunk)
+            for row in chunk:
+                ident_key = mapper.identity_key_from_primary_key([row[key] for key in pk_keys])
+                o = sess.identity_map.get(ident_key)
+                if o is not None:
+                    sess.expire(o, [key for key in row if key not in pk_keys])
+            count += len(chunk)
+        return count
+
+    @transaction
+    def update_where(cls, clause, *extra_clauses, **values):
+        """
+            Updates the records matching the given clause(s) with a single
+            UPDATE statement and returns the number of rows matched.
+
+            Instances already in the session are kept in sync using the
+            "evaluate" strategy of Query.update().  For clauses that can not be
+            evaluated in Python, pass synchronize_session='fetch' (or False).
+        """
+        synchronize_session = values.pop('synchronize_session', 'evaluate')
+        where_clause = cls.combine_clauses(clause, extra_clauses)
+        return cls._sa_sess().query(cls).filter(where_clause).update(
+            values, synchronize_session=synchronize_session
+        )
+
     @classmethod
     def update(cls, oid=None, **kwargs):
         """
@@ -78,18 +243,128 @@ class MethodsMixin(object):
         return cls.add(**kwargs)
 
     @classmethod
-    def get(cls, oid):
-        return cls._sa_sess().query(cls).get(oid)
+    def upsert(cls, conflict_cols, **kwargs):
+        """
+            Adds a record or, when one with the same values for conflict_cols
+            already exists, updates it.  This is done with a single native
+            upsert statement (see upsert_many()), so concurrent writers don't
+            end up with a failed INSERT and a rolled back transaction.
+
+            conflict_cols: attribute name, or list of attribute names, of a
+                unique constraint or index
+
+            Returns the instance.
+        """
+        cls.upsert_many(conflict_cols, [kwargs])
+        return cls.get_by(**dict((key, kwargs[key]) for key in tolist(conflict_cols)))
+
+    @transaction
+    def upsert_many(cls, conflict_cols, rows, chunk_size=1000):
+        """
+            Adds or updates many records in a single transaction using chunked
+            executemany upserts: INSERT ... ON CONFLICT on PostgreSQL and
+            SQLite and MERGE on MSSQL.
+
+            conflict_cols: attribute name, or list of attribute names, of a
+                unique constraint or index
+            rows: iterable of dicts keyed by attribute name.  The attributes
+                not in conflict_cols are updated on existing records.
+            chunk_size: the number of rows sent to the DB in each executemany
+
+            Like add_many(), no instances are created.  Column defaults are
+            applied to inserted rows, but "onupdate" defaults are not applied
+            to updated rows.
+
+            Returns the number of rows given.
+        """
+        sess = cls._sa_sess()
+        info = cls._sa_info()
+        mapper = info.mapper
+        col_keys = info.column_keys
+        conflict_cols = [col_keys[key] for key in tolist(conflict_cols)]
+        count = 0
+        for chunk in _chunked(rows, chunk_size):
+            # executemany needs the same keys in every row
+            by_keys = OrderedDict()
+            for row in chunk:
+                params = dict((col_keys[key], value) for key, value in six.iteritems(row))
+                by_keys.setdefault(tuple(sorted(params)), []).append(params)
+            for keys, params in six.iteritems(by_keys):
+                stmt = Upsert(
+                    mapper.local_table,
+                    conflict_cols,
+                    [key for key in keys if key not in conflict_cols]
+                )
+                sess.execute(stmt, params, mapper=mapper)
+            count += len(chunk)
+        return count
+
+    @classmethod
+    def get(cls, oid, mm_load=None):
+        return cls._sa_query(mm_load).get(oid)
+
+    @classmethod
+    def get_many(cls, oids, chunk_size=None):
+        """
+            Returns the instances for a list of primary keys in the same order,
+            with None for keys that have no record.  Composite keys are given
+            as tuples.
+
+            Instances already loaded in the session are used without a query,
+            the rest are loaded with one "IN" query per chunk_size keys.  By
+            default, chunk_size is as large as the dialect's limit on bind
+            parameters allows.
+        """
+        sess = cls._sa_sess()
+        info = cls._sa_info()
+        mapper = info.mapper
+        pk_cols = info.pk_cols
+        idents = [tuple(tolist(oid)) for oid in oids]
+
+        found = {}
+        seen = set()
+        # a list as well as the set, to query the keys in the order given
+        missing = []
+        for ident in idents:
+            if ident in seen:
+                continue
+            seen.add(ident)
+            o = sess.identity_map.get(mapper.identity_key_from_primary_key(ident))
+            # an expired instance would be refreshed one at a time on access
+            if o is not None and not sa_inspect(o).expired:
+                found[ident] = o
+            else:
+                missing.append(ident)
+
+        if missing:
+            if chunk_size is None:
+                dialect = sess.get_bind(mapper).dialect.name
+                chunk_size = max_bind_params(dialect) // len(pk_cols)
+            pk_keys = info.pk_keys
+            for chunk in _chunked(missing, chunk_size):
+                if len(pk_cols) == 1:
+                    clause = pk_cols[0].in_([ident[0] for ident in chunk])
+                else:
+                    clause = sasql.or_(*[
+                        sasql.and_(*[col == value for col, value in zip(pk_cols, ident)])
+                        for ident in chunk
+                    ])
+                for o in sess.query(cls).filter(clause):
+                    found[tuple(getattr(o, key) for key in pk_keys)] = o
+        return [found.get(ident) for ident in idents]
 
     @one_to_none
-    def get_by(cls, **kwargs):
+    def get_by(cls, mm_load=None, **kwargs):
         """
         Returns the instance of this class matching the given criteria or None
         if there is no record matching the criteria.
 
         If multiple records are returned, an exception is raised.
         """
-        return cls._sa_sess().query(cls).filter_by(**kwargs).one()
+        bq = cls._baked_filter_by(kwargs, load=mm_load)
+        if bq is None:
+            return cls._sa_query(mm_load).filter_by(**kwargs).one()
+        return cls._baked_result(bq, kwargs).one()
 
     @one_to_none
     def get_where(cls, clause, *extra_clauses):
@@ -107,34 +382,194 @@ class MethodsMixin(object):
         return cls.order_by_helper(cls._sa_sess().query(cls), order_by).first()
 
     @classmethod
-    def first_by(cls, order_by=None, **kwargs):
-        return cls.order_by_helper(cls._sa_sess().query(cls), order_by).filter_by(**kwargs).first()
+    def first_by(cls, order_by=None, mm_load=None, **kwargs):
+        bq = cls._baked_filter_by(kwargs, load=mm_load) if order_by is None else None
+        if bq is None:
+            return cls.order_by_helper(
+                cls._sa_query(mm_load), order_by
+            ).filter_by(**kwargs).first()
+        bq.add_criteria(lambda q: cls.order_by_helper(q, None))
+        return cls._baked_result(bq, kwargs).first()
 
     @classmethod
     def first_where(cls, clause, *extra_clauses, **kwargs):
         order_by = kwargs.pop('order_by', None)
+        load = kwargs.pop('mm_load', None)
         if kwargs:
-            raise ValueError('order_by is the only acceptable keyword arg')
+            raise ValueError('order_by and mm_load are the only acceptable keyword args')
         where_clause = cls.combine_clauses(clause, extra_clauses)
         return cls.order_by_helper(
-            cls._sa_sess().query(cls), order_by
+            cls._sa_query(load), order_by
         ).filter(where_clause).first()
 
     @classmethod
-    def list(cls, order_by=None):
-        return cls.order_by_helper(cls._sa_sess().query(cls), order_by).all()
+    def list(cls, order_by=None, mm_load=None):
+        return cls.order_by_helper(cls._sa_query(mm_load), order_by).all()
 
     @classmethod
-    def list_by(cls, order_by=None, **kwargs):
-        return cls.order_by_helper(cls._sa_sess().query(cls), order_by).filter_by(**kwargs).all()
+    def list_by(cls, order_by=None, mm_load=None, **kwargs):
+        bq = cls._baked_filter_by(kwargs, load=mm_load) if order_by is None else None
+        if bq is None:
+            return cls.order_by_helper(
+                cls._sa_query(mm_load), order_by
+            ).filter_by(**kwargs).all()
+        bq.add_criteria(lambda q: cls.order_by_helper(q, None))
+        return cls._baked_result(bq, kwargs).all()
 
     @classmethod
     def list_where(cls, clause, *extra_clauses, **kwargs):
         order_by = kwargs.pop('order_by', None)
+        load = kwargs.pop('mm_load', None)
         if kwargs:
-            raise ValueError('order_by is the only acceptable keyword arg')
+            raise ValueError('order_by and mm_load are the only acceptable keyword args')
+        where_clause = cls.combine_clauses(clause, extra_clauses)
+        return cls.order_by_helper(cls._sa_query(load), order_by).filter(where_clause).all()
+
+    @classmethod
+    def iter_all(cls, order_by=None, batch_size=1000):
+        """
+            Like list(), but returns an iterator that loads the records in
+            batches instead of holding all of them in memory at once.
+            See _iter_query() for how the batches are loaded.
+        """
+        return cls._iter_query(cls._sa_sess().query(cls), order_by, batch_size)
+
+    @classmethod
+    def iter_by(cls, order_by=None, batch_size=1000, **kwargs):
+        query = cls._sa_sess().query(cls).filter_by(**kwargs)
+        return cls._iter_query(query, order_by, batch_size)
+
+    @classmethod
+    def iter_where(cls, clause, *extra_clauses, **kwargs):
+        order_by = kwargs.pop('order_by', None)
+        batch_size = kwargs.pop('batch_size', 1000)
+        if kwargs:
+            raise ValueError('order_by and batch_size are the only acceptable keyword args')
         where_clause = cls.combine_clauses(clause, extra_clauses)
-        return cls.order_by_helper(cls._sa_sess().query(cls), order_by).filter(where_clause).all()
+        query = cls._sa_sess().query(cls).filter(where_clause)
+        return cls._iter_query(query, order_by, batch_size)
+
+    @classmethod
+    def _iter_query(cls, query, order_by, batch_size):
+        """
+            With the default ordering, the records are loaded batch_size at a
+            time using keyset pagination on the primary key, so each batch is
+            a cheap indexed query no matter how deep into the table it is.
+
+            With a custom order_by, the query is streamed with yield_per() on a
+            server side cursor, if the DBAPI supports them.
+        """
+        if order_by is None:
+            return cls._iter_keyset(query, batch_size)
+        query = cls.order_by_helper(query, order_by)
+        return iter(query.execution_options(stream_results=True).yield_per(batch_size))
+
+    @classmethod
+    def _iter_keyset(cls, query, batch_size):
+        info = cls._sa_info()
+        pk_cols = info.pk_cols
+        pk_keys = info.pk_keys
+        query = query.order_by(*pk_cols)
+        batch_query = query
+        while True:
+            batch = batch_query.limit(batch_size).all()
+            if not batch:
+                return
+            last = [getattr(batch[-1], key) for key in pk_keys]
+            for o in batch:
+                yield o
+            if len(batch) < batch_size:
+                return
+            batch_query = query.filter(seek_clause([(col, False) for col in pk_cols], last))
+
+    @classmethod
+    def paginate(cls, clause=None, *extra_clauses, **kwargs):
+        """
+            Returns a Page of the records matching the clauses, or of all
+            records when clause is None, using keyset (seek) pagination:
+
+                page = Car.paginate(Car.make == u'ford', per_page=50)
+                page = Car.paginate(Car.make == u'ford', per_page=50, after=page.next_cursor)
+
+            Instead of an OFFSET, which the DB has to count through, the next
+            page is found by a WHERE on the ordering values of the last record,
+            so deep pages cost as much as the first one.  page.next_cursor is
+            an opaque, URL safe string holding those values.
+
+            order_by: columns, optionally with .desc(), the primary key by
+                default.  The primary key is added to make the order unique.
+                The columns should not be nullable.
+            per_page: the number of records on a page, 20 by default
+            after: a next_cursor from a previous page with the same order_by
+        """
+        order_by = kwargs.pop('order_by', None)
+        per_page = kwargs.pop('per_page', 20)
+        after = kwargs.pop('after', None)
+        if kwargs:
+            raise ValueError('order_by, per_page and after are the only acceptable keyword args')
+        columns = order_columns(tolist(order_by))
+        for pk_col in cls._sa_info().pk_cols:
+            if not [col for col, _ in columns if col.shares_lineage(pk_col)]:
+                columns.append((pk_col, False))
+
+        query = cls._sa_sess().query(cls)
+        if clause is not None:
+            query = query.filter(cls.combine_clauses(clause, extra_clauses))
+        if after is not None:
+            query = query.filter(seek_clause(columns, decode_cursor(after, len(columns))))
+        query = query.add_columns(*[col for col, _ in columns]).order_by(
+            *[col.desc() if descending else col for col, descending in columns]
+        )
+        # one extra row tells whether there is a next page
+        rows = query.limit(per_page + 1).all()
+        has_next = len(rows) > per_page
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(rows[-1][1:]) if has_next else None
+        return Page([row[0] for row in rows], per_page, has_next, next_cursor=next_cursor)
+
+    @classmethod
+    def page_where(cls, clause=None, *extra_clauses, **kwargs):
+        """
+            Returns a Page of the records matching the clauses, or of all
+            records when clause is None, using LIMIT/OFFSET.  Unlike
+            paginate(), any page can be asked for by number, but deep pages
+            get slower as the DB counts through the rows before them.
+
+            order_by: like list_where(), the primary key by default
+            per_page: the number of records on a page, 20 by default
+            page: the page number, from 1
+            total: True to count the matching records for page.total and
+                page.pages.  Counting can cost as much as the page itself, so
+                a total from an earlier page (e.g. kept in a cache) can be
+                given instead and is used as is.
+        """
+        order_by = kwargs.pop('order_by', None)
+        per_page = kwargs.pop('per_page', 20)
+        page = kwargs.pop('page', 1)
+        total = kwargs.pop('total', False)
+        if kwargs:
+            raise ValueError('order_by, per_page, page and total are the only acceptable'
+                             ' keyword args')
+        if page < 1:
+            raise ValueError('page numbers start at 1')
+        where_clause = None
+        if clause is not None:
+            where_clause = cls.combine_clauses(clause, extra_clauses)
+
+        query = cls.order_by_helper(cls._sa_sess().query(cls), order_by)
+        if where_clause is not None:
+            query = query.filter(where_clause)
+        items = query.limit(per_page + 1).offset((page - 1) * per_page).all()
+        has_next = len(items) > per_page
+
+        if total is True:
+            count_query = cls._count_query(cls._sa_sess())
+            if where_clause is not None:
+                count_query = count_query.filter(where_clause)
+            total = count_query.scalar()
+        elif total is False:
+            total = None
+        return Page(items[:per_page], per_page, has_next, page=page, total=total)
 
     @classmethod
     def pairs(cls, fields, order_by=None, _result=None):
@@ -151,28 +586,60 @@ class MethodsMixin(object):
                 Fruit.pairs('id:name')
 
             order_by = order_by clause or iterable of order_by clauses
+
+            When both fields are columns, only they are SELECTed and no
+            instances are loaded.  Otherwise, e.g. for a relationship or a
+            plain @property, the instances are loaded and the fields read from
+            them.
         """
-        key_field_name, value_field_name = fields.split(':')
-        if _result is None:
-            _result = cls.list(order_by)
-        retval = []
-        for obj in _result:
-            retval.append((
-                getattr(obj, key_field_name),
-                getattr(obj, value_field_name)
-            ))
-        return retval
+        if _result is not None:
+            return cls._pairs_from_instances(fields, _result)
+        query = cls.order_by_helper(cls._pairs_query(fields), order_by)
+        return cls._pairs_of(fields, query)
 
     @classmethod
     def pairs_by(cls, fields, order_by=None, **kwargs):
-        result = cls.list_by(order_by, **kwargs)
-        return cls.pairs(fields, _result=result)
+        query = cls.order_by_helper(cls._pairs_query(fields), order_by).filter_by(**kwargs)
+        return cls._pairs_of(fields, query)
 
     @classmethod
     def pairs_where(cls, fields, clause, *extra_clauses, **kwargs):
-        result = cls.list_where(clause, *extra_clauses, **kwargs)
-        pairs = cls.pairs(fields, _result=result)
-        return pairs
+        order_by = kwargs.pop('order_by', None)
+        if kwargs:
+            raise ValueError('order_by is the only acceptable keyword arg')
+        where_clause = cls.combine_clauses(clause, extra_clauses)
+        query = cls.order_by_helper(cls._pairs_query(fields), order_by).filter(where_clause)
+        return cls._pairs_of(fields, query)
+
+    @classmethod
+    def _pairs_selectable(cls, fields):
+        # columns and hybrid expressions, not relationships, which query()
+        # would turn into their join condition
+        info = cls._sa_info()
+        return all(
+            name in info.column_names or isinstance(info.attr(name), sasql.ColumnElement)
+            for name in fields.split(':')
+        )
+
+    @classmethod
+    def _pairs_query(cls, fields):
+        if cls._pairs_selectable(fields):
+            return cls.query(*fields.split(':'))
+        return cls.query()
+
+    @classmethod
+    def _pairs_of(cls, fields, query):
+        if cls._pairs_selectable(fields):
+            return [tuple(row) for row in query]
+        return cls._pairs_from_instances(fields, query)
+
+    @classmethod
+    def _pairs_from_instances(cls, fields, instances):
+        key_field_name, value_field_name = fields.split(':')
+        return [
+            (getattr(obj, key_field_name), getattr(obj, value_field_name))
+            for obj in instances
+        ]
 
     @transaction
     def delete(cls, oid):
@@ -194,69 +661,276 @@ class MethodsMixin(object):
 
     @classmethod
     def count(cls):
-        return cls._sa_sess().query(cls).count()
+        return cls._count_query(cls._sa_sess()).scalar()
 
     @classmethod
     def count_by(cls, **kwargs):
-        return cls._sa_sess().query(cls).filter_by(**kwargs).count()
+        bq = cls._baked_filter_by(kwargs, count=True)
+        if bq is None:
+            return cls._count_query(cls._sa_sess()).filter_by(**kwargs).scalar()
+        return cls._baked_result(bq, kwargs).one()[0]
 
     @classmethod
     def count_where(cls, clause, *extra_clauses):
         where_clause = cls.combine_clauses(clause, extra_clauses)
-        return cls._sa_sess().query(cls).filter(where_clause).count()
+        return cls._count_query(cls._sa_sess()).filter(where_clause).scalar()
+
+    @classmethod
+    def _count_query(cls, sess):
+        """
+            SELECT count(*) FROM <table>, without the subquery Query.count()
+            wraps around the full entity SELECT.  select_from() does not add
+            the discriminator of a single table inheritance subclass, so it is
+            added here.
+        """
+        query = sess.query(sasql.func.count(sasql.literal_column('*'))).select_from(cls)
+        criterion = cls._sa_info().single_table_criterion
+        if criterion is not None:
+            query = query.filter(criterion)
+        return query
+
+    @classmethod
+    def count_estimate(cls):
+        """
+            Returns the approximate number of records from the DB's planner
+            statistics: pg_class.reltuples on PostgreSQL and sys.partitions on
+            MSSQL.  Much cheaper than count() on large tables, but only as
+            accurate as the statistics.
+
+            Falls back to count() on other dialects, when the table has no
+            statistics yet, or for single table inheritance subclasses, which
+            only have some of the table's rows.
+        """
+        sess = cls._sa_sess()
+        info = cls._sa_info()
+        mapper = info.mapper
+        table_name = mapper.local_table.fullname
+        dialect = sess.get_bind(mapper).dialect.name
+        # the table's statistics count the rows of every class it maps
+        whole_table = info.single_table_criterion is None
+        estimate = None
+        if whole_table and dialect == 'postgresql':
+            sql = 'SELECT reltuples FROM pg_class WHERE oid = CAST(:name AS regclass)'
+            estimate = sess.execute(sql, {'name': table_name}, mapper=mapper).scalar()
+        elif whole_table and dialect == 'mssql':
+            sql = 'SELECT SUM(rows) FROM sys.partitions ' \
+                'WHERE object_id = OBJECT_ID(:name) AND index_id IN (0, 1)'
+            estimate = sess.execute(sql, {'name': table_name}, mapper=mapper).scalar()
+        # reltuples is -1 (or 0 on older PostgreSQL) until the table is analyzed
+        if estimate is None or estimate <= 0:
+            return cls.count()
+        return int(estimate)
 
     def to_dict(self, exclude=[]):
-        col_prop_names = self.sa_column_names()
+        col_prop_names = self._sa_column_names()
         data = dict([(name, getattr(self, name))
                      for name in col_prop_names if name not in exclude])
         return data
 
+    @classmethod
+    def to_dicts(cls, instances_or_query, exclude=()):
+        """
+            Like calling to_dict() on every instance, but faster for many.
+            When given a Query for this class, only the columns are selected
+            and the dicts are built from the result rows, without loading
+            instances.
+        """
+        info = cls._sa_info()
+        names = [name for name in info.column_names if name not in exclude]
+        if isinstance(instances_or_query, saorm.Query):
+            rows = instances_or_query.with_entities(*[info.attr(name) for name in names])
+            return [dict(zip(names, row)) for row in rows]
+        if len(names) == 1:
+            return [{names[0]: getattr(instance, names[0])} for instance in instances_or_query]
+        getter = operator.attrgetter(*names)
+        return [dict(zip(names, getter(instance))) for instance in instances_or_query]
+
     def from_dict(self, data):
         """
         Update a mapped class with data from a JSON-style nested dict/list
         structure.
-        """
-        # surrogate can be guessed from autoincrement/sequence but I guess
-        # that's not 100% reliable, so we'll need an override
 
-        mapper = saorm.object_mapper(self)
-
-        for key, value in six.iteritems(data):
-            if isinstance(value, dict):
-                dbvalue = getattr(self, key)
-                rel_class = mapper.get_property(key).mapper.class_
-                pk_props = rel_class._descriptor.primary_key_properties
+        Nested dicts and lists of dicts set relationships.  A nested row with
+        the primary key of an existing record updates that record, any other
+        row creates a new one.  The existing records are loaded with one "IN"
+        query per relationship, for all of its rows, at each level of nesting.
+        """
+        self._sa_from_dicts([(self, data)])
 
-                # If the data doesn't contain any pk, and the relationship
-                # already has a value, update that record.
-                if not [1 for p in pk_props if p.key in data] and \
-                        dbvalue is not None:
-                    dbvalue.from_dict(value)
+    @classmethod
+    def _sa_from_dicts(cls, pairs):
+        """ from_dict() for a list of (instance, data) tuples at once """
+        relationships = cls._sa_info().relationships
+        # relationship key -> list of (instance, nested dict or list)
+        nested = OrderedDict()
+        for instance, data in pairs:
+            for key, value in six.iteritems(data):
+                if isinstance(value, dict) or \
+                        (isinstance(value, list) and value and isinstance(value[0], dict)):
+                    nested.setdefault(key, []).append((instance, value))
                 else:
-                    record = rel_class.update_or_create(value)
-                    setattr(self, key, record)
-            elif isinstance(value, list) and \
-                    value and isinstance(value[0], dict):
+                    setattr(instance, key, value)
 
-                rel_class = mapper.get_property(key).mapper.class_
-                new_attr_value = []
+        for key, values in six.iteritems(nested):
+            rel_class = relationships[key]
+            pk_keys = rel_class._sa_info().pk_keys
+            rows = []
+            updates = []
+            # (instance, is a list, number of rows) for each value given a new record
+            assigns = []
+            for instance, value in values:
+                if isinstance(value, dict):
+                    dbvalue = getattr(instance, key)
+                    # If the data doesn't contain any pk, and the relationship
+                    # already has a value, update that record.
+                    if dbvalue is not None and not [1 for k in pk_keys if k in value]:
+                        updates.append((dbvalue, value))
+                    else:
+                        rows.append(value)
+                        assigns.append((instance, False, 1))
+                    continue
                 for row in value:
                     if not isinstance(row, dict):
                         raise Exception(
                             'Cannot send mixed (dict/non dict) data '
                             'to list relationships in from_dict data.')
-                    record = rel_class.update_or_create(row)
-                    new_attr_value.append(record)
-                setattr(self, key, new_attr_value)
+                rows.extend(value)
+                assigns.append((instance, True, len(value)))
+
+            records = rel_class._sa_records_for(rows)
+            offset = 0
+            for instance, is_list, count in assigns:
+                assigned = records[offset:offset + count]
+                offset += count
+                setattr(instance, key, assigned if is_list else assigned[0])
+            # the next level of nesting, for all of this relationship's rows at once
+            rel_class._sa_from_dicts(updates + list(zip(records, rows)))
+
+    @classmethod
+    def _sa_records_for(cls, rows):
+        """
+            Returns a record for each from_dict() row: the existing record when
+            the row has its primary key, otherwise a new instance.  The
+            existing records are loaded with get_many().
+        """
+        pk_keys = cls._sa_pk_keys()
+        idents = [
+            tuple(row.get(key) for key in pk_keys) for row in rows
+        ]
+        idents = [ident if None not in ident else None for ident in idents]
+        lookup = [ident for ident in idents if ident is not None]
+        existing = {}
+        if lookup:
+            # records from the rest of the payload may not be complete yet
+            with cls._sa_sess().no_autoflush:
+                existing = dict(zip(lookup, cls.get_many(lookup)))
+        records = []
+        for ident in idents:
+            record = existing.get(ident) if ident is not None else None
+            records.append(record if record is not None else cls())
+        return records
+
+    @classmethod
+    def _baked_filter_by(cls, kwargs, count=False, load=None):
+        """
+            Returns a BakedQuery equivalent to query(cls).filter_by(**kwargs),
+            or None if one of the keys is not a column attribute.  The query is
+            built and its SQL compiled once per class and set of keys, only
+            the bind values change between calls.
+
+            count: when True, the query SELECTs count(*) instead of instances
+            load: like the read helpers' mm_load argument.  None is returned when
+                it has loader options, which can not be part of a cache key.
+        """
+        info = cls._sa_info()
+        keys = sorted(kwargs)
+        if [key for key in keys if key not in info.column_names]:
+            return None
+        load_key, load_options = (None, []) if count else cls._sa_load_options(load)
+        if load_options and load_key is None:
+            return None
+        # None renders as "IS NULL", so which keys are None is part of the cache key
+        null_keys = tuple(key for key in keys if kwargs[key] is None)
+        value_keys = tuple(key for key in keys if kwargs[key] is not None)
+
+        def criteria(query):
+            clauses = [info.attr(key) == sa.bindparam('mm_' + key) for key in value_keys]
+            clauses.extend(info.attr(key).is_(None) for key in null_keys)
+            return query.filter(*clauses)
+
+        if count:
+            bq = _bakery(lambda sess: cls._count_query(sess), cls)
+        else:
+            bq = _bakery(lambda sess: sess.query(cls), cls)
+        bq.add_criteria(criteria, null_keys, value_keys)
+        if load_options:
+            bq.add_criteria(lambda query: query.options(*load_options), load_key)
+        return bq
+
+    @classmethod
+    def _sa_query(cls, load=None):
+        """ query(cls) with the loader options for `load` """
+        query = cls._sa_sess().query(cls)
+        load_options = cls._sa_load_options(load)[1]
+        if load_options:
+            query = query.options(*load_options)
+        return query
+
+    @classmethod
+    def _sa_load_options(cls, load):
+        """
+            Returns a (cache key, loader options) tuple for the `mm_load`
+            argument of the read helpers, which is one of these or a list of
+            them:
+
+                'comments': a relationship name or a dotted path of them, like
+                    'comments.author', loaded with mm_eager_strategy
+                {'comments': 'joined'}: paths with their strategy, 'selectin',
+                    'joined' or 'subquery'
+                saorm.joinedload(...): a loader option, used as is
+
+            Every relationship on a path is loaded eagerly.  None means the
+            class's mm_eager_load and () loads nothing eagerly.  The cache key
+            is None when loader options were given.
+        """
+        if load is None:
+            load = cls.mm_eager_load
+        paths = []
+        options = []
+        for item in tolist(load):
+            if isinstance(item, six.string_types):
+                paths.append((item, cls.mm_eager_strategy))
+            elif isinstance(item, dict):
+                paths.extend(sorted(six.iteritems(item)))
             else:
-                setattr(self, key, value)
+                options.append(item)
+        for path, strategy in paths:
+            try:
+                loader = _loader_options[strategy]
+            except KeyError:
+                raise ValueError('eager load strategy must be one of: %s'
+                                 % ', '.join(sorted(_loader_options)))
+            option = saorm
+            for key in path.split('.'):
+                option = getattr(option, loader)(key)
+            options.append(option)
+        return (None if len(options) > len(paths) else tuple(paths)), options
+
+    @classmethod
+    def _baked_result(cls, bq, kwargs):
+        sess = cls._sa_sess()
+        # baked queries need the Session itself, not the scoped_session
+        if isinstance(sess, saorm.scoped_session):
+            sess = sess()
+        params = dict(('mm_' + key, value) for key, value in six.iteritems(kwargs)
+                      if value is not None)
+        return bq(sess).params(params)
 
     @classmethod
     def order_by_helper(cls, query, order_by):
         if order_by is not None:
             return query.order_by(*tolist(order_by))
-        pk_cols = sa_inspect(cls).primary_key
-        return query.order_by(*pk_cols)
+        return query.order_by(*cls._sa_info().pk_cols)
 
     @classmethod
     def combine_clauses(cls, clause, extra_clauses):
@@ -265,9 +939,24 @@ class MethodsMixin(object):
         return sasql.and_(clause, *extra_clauses)
 
     @classmethod
-    def sa_column_names(self):
-        return [p.key for p in self.__mapper__.iterate_properties
-                if isinstance(p, saorm.ColumnProperty)]
+    def _sa_info(cls):
+        try:
+            return _mapper_info[cls]
+        except KeyError:
+            info = _mapper_info[cls] = MapperInfo(cls)
+            return info
+
+    @classmethod
+    def _sa_pk_keys(cls):
+        return cls._sa_info().pk_keys
+
+    @classmethod
+    def sa_column_names(cls):
+        return list(cls._sa_info().column_names)
+
+    @classmethod
+    def _sa_column_names(cls):
+        return cls._sa_info().column_names
 
 
 class DefaultMixin(saval.ValidationMixin, DefaultColsMixin, MethodsMixin):
@@ -290,12 +979,62 @@ def declarative_base(*args, **kwargs):
 ###
 #   Lookup Functionality
 ###
+
+# process level cache of lookup table rows, keyed by class
+_lookup_caches = {}
+
+# session.info key for the lookup classes written to in the session's current
+# transaction, whose caches are cleared once it is committed
+_lookup_pending_key = 'sqlalchemybwc.lookup_cache_pending'
+
+
+@sa.event.listens_for(saorm.Session, 'after_commit')
+def _clear_pending_lookup_caches(sess):
+    # also fired when a SAVEPOINT is released
+    if sess.transaction is not None and sess.transaction.nested:
+        return
+    for cls in sess.info.pop(_lookup_pending_key, ()):
+        cls.lookup_cache_clear()
+
+
+def _lookup_cache_writer(meth_name):
+    """
+        wraps a MethodsMixin write method so that it clears the lookup cache
+        after the transaction it writes in is committed.  Clearing it before
+        would let a read in between cache the rows from before the write.
+    """
+    def writer(cls, *args, **kwargs):
+        if cls.lookup_cache_ttl is not None:
+            # before the call, which commits unless it is nested in a savepoint
+            cls._sa_sess().info.setdefault(_lookup_pending_key, set()).add(cls)
+        return getattr(super(LookupMixin, cls), meth_name)(*args, **kwargs)
+    writer.__name__ = meth_name
+    writer.__doc__ = getattr(MethodsMixin, meth_name).__doc__
+    return classmethod(writer)
+
+
 class LookupMixin(DefaultMixin):
     @sadec.declared_attr
     def label(cls):
         return sa.Column(sa.Unicode(255), nullable=False, unique=True)
     active_flag = sa.Column(SmallIntBool, nullable=False, server_default=sasql.text('1'))
 
+    # Number of seconds list_active(), pairs_active() and get_by_label() can
+    # use rows cached in this process instead of querying the DB.  None
+    # disables the cache.  Writes through this class's helpers clear the
+    # cache when committed, other changes are picked up when it expires.
+    lookup_cache_ttl = None
+
+    add = _lookup_cache_writer('add')
+    add_many = _lookup_cache_writer('add_many')
+    edit = _lookup_cache_writer('edit')
+    edit_many = _lookup_cache_writer('edit_many')
+    update_where = _lookup_cache_writer('update_where')
+    upsert_many = _lookup_cache_writer('upsert_many')
+    delete = _lookup_cache_writer('delete')
+    delete_where = _lookup_cache_writer('delete_where')
+    delete_all = _lookup_cache_writer('delete_all')
+
     @classmethod
     def testing_create(cls, label=None, active=True):
         if label is None:
@@ -304,26 +1043,101 @@ class LookupMixin(DefaultMixin):
 
     @classmethod
     def list_active(cls, include_ids=None, order_by=None):
+        if not include_ids and order_by is None:
+            cache = cls._lookup_cache()
+            if cache is not None:
+                return [cls._from_lookup_cache(row) for row in cache['active']]
+        if order_by is None:
+            order_by = cls.label
+        return cls.list_where(cls._active_clause(include_ids), order_by=order_by)
+
+    @classmethod
+    def pairs_active(cls, include_ids=None, order_by=None):
+        if not include_ids and order_by is None:
+            cache = cls._lookup_cache()
+            if cache is not None:
+                return [(row['id'], row['label']) for row in cache['active']]
         if order_by is None:
             order_by = cls.label
+        return cls.pairs_where('id:label', cls._active_clause(include_ids), order_by=order_by)
+
+    @classmethod
+    def _active_clause(cls, include_ids):
         if include_ids:
             include_ids = tolist(include_ids)
-            clause = sasql.or_(
+            return sasql.or_(
                 cls.active_flag == 1,
                 cls.id.in_(include_ids)
             )
-        else:
-            clause = cls.active_flag == 1
-        return cls.list_where(clause, order_by=order_by)
-
-    @classmethod
-    def pairs_active(cls, include_ids=None, order_by=None):
-        result = cls.list_active(include_ids, order_by=order_by)
-        return cls.pairs('id:label', _result=result)
+        return cls.active_flag == 1
 
     @classmethod
     def get_by_label(cls, label):
+        cache = cls._lookup_cache()
+        if cache is not None:
+            row = cache['by_label'].get(label)
+            return None if row is None else cls._from_lookup_cache(row)
         return cls.get_by(label=label)
 
+    @classmethod
+    def lookup_cache_version(cls):
+        """
+            Returns a stamp identifying the current version of this lookup
+            table, the cache is reloaded when it changes.  Override this, along
+            with lookup_cache_bump(), to invalidate the caches of all processes
+            through a shared store (e.g. a counter kept in memcached).  It is
+            called on every cached read, so it needs to be cheap.
+        """
+        return None
+
+    @classmethod
+    def lookup_cache_bump(cls):
+        """
+            Called after every committed write through this class's helpers,
+            override to change the stamp returned by lookup_cache_version().
+        """
+        pass
+
+    @classmethod
+    def lookup_cache_clear(cls):
+        if cls.lookup_cache_ttl is None:
+            return
+        _lookup_caches.pop(cls, None)
+        cls.lookup_cache_bump()
+
+    @classmethod
+    def _lookup_cache(cls):
+        if cls.lookup_cache_ttl is None:
+            return None
+        version = cls.lookup_cache_version()
+        cache = _lookup_caches.get(cls)
+        if cache is None or cache['expires'] < time.time() or cache['version'] != version:
+            col_names = cls.sa_column_names()
+            query = cls.order_by_helper(cls.query(*col_names), cls.label)
+            rows = [dict(zip(col_names, row)) for row in query]
+            cache = {
+                'expires': time.time() + cls.lookup_cache_ttl,
+                'version': version,
+                'active': [row for row in rows if row['active_flag']],
+                'by_label': dict((row['label'], row) for row in rows),
+            }
+            _lookup_caches[cls] = cache
+        return cache
+
+    @classmethod
+    def _from_lookup_cache(cls, row):
+        """
+            Returns the instance for a cached row without emitting SQL: either
+            the one already in the session or a new one merged into it.
+        """
+        sess = cls._sa_sess()
+        ident_key = cls._sa_info().mapper.identity_key_from_primary_key([row['id']])
+        o = sess.identity_map.get(ident_key)
+        if o is None:
+            o = cls(**row)
+            saorm.make_transient_to_detached(o)
+            o = sess.merge(o, load=False)
+        return o
+
     def __repr__(self):
         return '<%s %s:%s>' % (self.__class__.__name__, self.id, self.label)
@@ -7,13 +7,16 @@
 """
 from functools import wraps
 import inspect
+import random
+import time
 
 from decorator import decorator
 from sqlalchemy.orm.exc import NoResultFound
 
 from compstack.sqlalchemy import db
 from compstack.sqlalchemy.lib.helpers import is_unique_exc, is_null_exc, is_fk_exc, \
-    is_check_const_exc
+    is_check_const_exc, is_retryable_exc
+from compstack.sqlalchemy.lib.routing import use_primary
 
 
 def _find_sa_sess(args):
@@ -32,31 +35,81 @@ def _find_sa_sess(args):
     return db.sess
 
 
-@decorator
-def transaction_ncm(f, *args, **kwargs):
+# session.info keys for the number of decorated transactions in progress and
+# whether nested ones should use savepoints
+_depth_key = 'sqlalchemybwc.transaction_depth'
+_savepoint_key = 'sqlalchemybwc.transaction_savepoints'
+
+
+def transaction_ncm(f=None, savepoint=False, retries=0, backoff=0.05, max_backoff=2):
     """
         decorates a function so that a DB transaction is always committed after
         the wrapped function returns and also rolls back the transaction if
         an unhandled exception occurs.
 
-        'ncm' = non class method (version)
-    """
-    dbsess = _find_sa_sess(args)
+        Can be used bare or with options:
 
-    try:
-        retval = f(*args, **kwargs)
-        dbsess.commit()
-        return retval
-    except Exception:
-        dbsess.rollback()
-        raise
+            @transaction_ncm(savepoint=True, retries=3)
 
+        savepoint: decorated functions called while this one runs, and this
+            one when called while another decorated function runs, use a
+            SAVEPOINT which is released, not committed, on return and rolled
+            back on an exception.  The outermost transaction decides what is
+            committed.  When not nested, the transaction is committed as usual.
+        retries: the number of times to call the function again, after
+            rolling back, when it fails with a serialization failure, deadlock
+            or lock timeout (see helpers.is_retryable_exc()).  Only the
+            outermost transaction retries.
+        backoff & max_backoff: retry N waits a random time of up to
+            backoff * 2 ** N seconds, but no more than max_backoff
 
-def transaction(f):
+        'ncm' = non class method (version)
+    """
+    if f is None:
+        return lambda f: transaction_ncm(f, savepoint, retries, backoff, max_backoff)
+
+    def run_transaction(f, *args, **kwargs):
+        dbsess = _find_sa_sess(args)
+        # reads after the writes should see them, so a routing session stays
+        # on the primary
+        use_primary(dbsess)
+        depth = dbsess.info.get(_depth_key, 0)
+        outer_savepoints = dbsess.info.get(_savepoint_key, False)
+        use_savepoints = savepoint or outer_savepoints
+        attempt = 0
+        while True:
+            nested = dbsess.begin_nested() if use_savepoints and depth else None
+            dbsess.info[_depth_key] = depth + 1
+            dbsess.info[_savepoint_key] = use_savepoints
+            try:
+                retval = f(*args, **kwargs)
+                if nested is not None:
+                    nested.commit()
+                else:
+                    dbsess.commit()
+                return retval
+            except Exception as e:
+                if nested is not None:
+                    nested.rollback()
+                else:
+                    dbsess.rollback()
+                if depth or attempt >= retries or not is_retryable_exc(e):
+                    raise
+            finally:
+                dbsess.info[_depth_key] = depth
+                dbsess.info[_savepoint_key] = outer_savepoints
+            time.sleep(random.uniform(0, min(max_backoff, backoff * 2 ** attempt)))
+            attempt += 1
+    return decorator(run_transaction, f)
+
+
+def transaction(f=None, **kwargs):
     """
         like transaction_ncm() but makes the function a class method
     """
-    return classmethod(transaction_ncm(f))
+    if f is None:
+        return lambda f: classmethod(transaction_ncm(f, **kwargs))
+    return classmethod(transaction_ncm(f, **kwargs))
 
 
 @decorator
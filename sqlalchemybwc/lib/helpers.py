@@ -3,7 +3,7 @@ import re
 from blazeutils import tolist
 from savalidation import ValidationError
 import six
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import DBAPIError, IntegrityError
 
 from compstack.sqlalchemy import db
 
@@ -15,6 +15,19 @@ def sa_dialect_is(*testfor):
     return False
 
 
+def max_bind_params(dialect):
+    """
+        The number of bind parameters that can safely be used in a single
+        statement, leaving some room below the DB's limit (2100 for MSSQL and
+        999 for SQLite before 3.32) for parameters in the rest of the statement.
+    """
+    if dialect == 'mssql':
+        return 2000
+    elif dialect == 'sqlite':
+        return 900
+    return 10000
+
+
 def is_unique_exc(exc, db=db):
     if isinstance(exc, ValidationError):
         return len(exc.invalid_instances) == 1 and \
@@ -183,6 +196,37 @@ def _is_check_const(dialect, msg, constraint_name):
     return False
 
 
+def is_retryable_exc(exc, db=db):
+    """
+        True when the exception is a serialization failure, deadlock or lock
+        timeout, which a transaction can expect to get past by starting over.
+    """
+    if not isinstance(exc, DBAPIError) or isinstance(exc, IntegrityError):
+        return False
+    return _is_retryable_msg(db.engine.dialect.name, str(exc))
+
+
+def _is_retryable_msg(dialect, msg):
+    """
+        easier unit testing this way
+    """
+    if dialect == 'postgresql':
+        if 'could not serialize access' in msg or 'deadlock detected' in msg:
+            return True
+    elif dialect == 'mssql':
+        if 'was deadlocked on' in msg or 'Snapshot isolation transaction aborted' in msg:
+            return True
+    elif dialect == 'mysql':
+        if 'Deadlock found when trying to get lock' in msg or 'Lock wait timeout exceeded' in msg:
+            return True
+    elif dialect == 'sqlite':
+        if 'database is locked' in msg:
+            return True
+    else:
+        raise ValueError('is_retryable_exc() does not yet support dialect: %s' % dialect)
+    return False
+
+
 def clear_db():
     if db.engine.dialect.name == 'postgresql':
         sql = []
@@ -0,0 +1,388 @@
+"""
+    Statistics about the statements an engine executes, collected per request
+    (or any other unit of work) on the thread doing the work.
+"""
+import logging
+from logging.handlers import RotatingFileHandler
+import os
+import re
+import threading
+import time
+import traceback
+
+import sqlalchemy as sa
+
+slow_query_log = logging.getLogger('sqlalchemybwc.slow_queries')
+
+# frames from these are left out of the call stack of a slow query
+_stack_skip_paths = (
+    os.path.dirname(os.path.abspath(sa.__file__)),
+    os.path.splitext(os.path.abspath(__file__))[0],
+)
+
+# a parenthesized list of bind placeholders in any of the DBAPI param styles
+_bind_list_re = re.compile(
+    r'\(\s*(?:\?|%s|%\(\w+\)s|:\w+)(?:\s*,\s*(?:\?|%s|%\(\w+\)s|:\w+))*\s*\)'
+)
+_whitespace_re = re.compile(r'\s+')
+# SELECTs that lock rows or advance sequences, which EXPLAIN ANALYZE would do again
+_side_effects_re = re.compile(
+    r'\bFOR\s+(?:NO\s+KEY\s+UPDATE|UPDATE|KEY\s+SHARE|SHARE)\b|\b(?:nextval|setval)\s*\(',
+    re.IGNORECASE
+)
+
+
+class NPlusOneError(AssertionError):
+    """
+        A statement was executed more times than allowed, usually the lazy
+        load of a relationship from inside a loop.
+    """
+    def __init__(self, repeated, threshold):
+        self.repeated = repeated
+        self.threshold = threshold
+        AssertionError.__init__(self, format_repeated(repeated, threshold))
+
+
+def normalize_sql(statement):
+    """
+        Returns the statement with whitespace collapsed and lists of bind
+        placeholders, like those from IN (...) and multi-row VALUES, reduced
+        to "(?)" so statements that only differ in their number of parameters
+        are the same.
+    """
+    statement = _whitespace_re.sub(' ', statement).strip()
+    return _bind_list_re.sub('(?)', statement)
+
+
+def render_literal_sql(statement, dialect, params=None, column_keys=None):
+    """
+        Returns the SQL of a statement with its bind parameters rendered inline
+        as literals.  Values in `params`, keyed by bind parameter name like the
+        compiled parameters of an execution, take precedence over the values
+        of the bind parameters in the statement.  `column_keys` limits the
+        columns of an INSERT or UPDATE, as it does for statement.compile().
+
+        WARNING: the result is for reading only, executing it can result in an
+        SQL Injection attack.
+    """
+    compiler = statement._compiler(dialect)
+
+    class LiteralCompiler(compiler.__class__):
+        def visit_bindparam(
+                self, bindparam, within_columns_clause=False,
+                literal_binds=False, **kwargs
+        ):
+            name = self._truncate_bindparam(bindparam)
+            if params and name in params:
+                return self.render_literal_value(params[name], bindparam.type)
+            return super(LiteralCompiler, self).render_literal_bindparam(
+                bindparam, within_columns_clause=within_columns_clause,
+                literal_binds=literal_binds, **kwargs
+            )
+
+    compiler = LiteralCompiler(dialect, statement, column_keys=column_keys)
+    return compiler.process(statement)
+
+
+def format_repeated(repeated, threshold):
+    lines = ['statements executed more than %s times:' % threshold]
+    lines.extend('    %sx %s' % (count, sql) for count, sql in repeated)
+    return '\n'.join(lines)
+
+
+class QueryStats(object):
+    """
+        statements: the number of statements executed
+        duration: the total seconds spent executing them
+        rows_affected: the rows changed by INSERT/UPDATE/DELETE statements,
+            from the DBAPI cursor rowcounts.  Rows fetched by SELECTs are not
+            counted: most DBAPIs, sqlite3 and pyodbc included, do not report
+            them before they are fetched.
+        slowest: list of (duration, normalized sql) tuples for the slowest
+            statements, slowest first
+        selects: dict of normalized SELECT statement -> times executed, used to
+            find the repeated statements of an N+1 query problem
+    """
+    def __init__(self, slowest_count=5):
+        self.slowest_count = slowest_count
+        self.statements = 0
+        self.duration = 0.0
+        self.rows_affected = 0
+        self.slowest = []
+        self.selects = {}
+
+    def record(self, statement, duration, rowcount):
+        self.statements += 1
+        self.duration += duration
+        normalized = None
+        if statement.lstrip()[:6].upper() == 'SELECT':
+            normalized = normalize_sql(statement)
+            self.selects[normalized] = self.selects.get(normalized, 0) + 1
+        elif rowcount > 0:
+            self.rows_affected += rowcount
+        if not self.slowest_count:
+            return
+        if len(self.slowest) < self.slowest_count or duration > self.slowest[-1][0]:
+            self.slowest.append((duration, normalized or normalize_sql(statement)))
+            self.slowest.sort(key=lambda item: item[0], reverse=True)
+            del self.slowest[self.slowest_count:]
+
+    def repeated(self, threshold):
+        """
+            Returns a list of (times executed, normalized sql) tuples for the
+            SELECT statements executed more than `threshold` times, most
+            repeated first.
+        """
+        repeated = [(count, sql) for sql, count in self.selects.items() if count > threshold]
+        repeated.sort(key=lambda item: item[0], reverse=True)
+        return repeated
+
+    def check_repeated(self, threshold):
+        """ raises NPlusOneError when a SELECT was executed more than `threshold` times """
+        repeated = self.repeated(threshold)
+        if repeated:
+            raise NPlusOneError(repeated, threshold)
+
+    def as_dict(self):
+        return {
+            'statements': self.statements,
+            'duration': self.duration,
+            'rows_affected': self.rows_affected,
+            'slowest': list(self.slowest),
+        }
+
+    def __repr__(self):
+        return '<QueryStats statements=%s duration=%.4f rows_affected=%s>' % (
+            self.statements, self.duration, self.rows_affected)
+
+
+class CursorTimer(object):
+    """
+        Base for the classes timing the statements an engine executes with its
+        cursor execution events.  Subclasses implement statement_done().  The
+        engine can be given later, with listen(), when it is created lazily,
+        and more engines, like read replicas, can be added with listen().
+    """
+    def __init__(self, engine=None):
+        self.engines = []
+        self._start_key = 'sqlalchemybwc_%s_start' % id(self)
+        if engine is not None:
+            self.listen(engine)
+
+    def listen(self, engine):
+        """ start timing the statements of `engine` too """
+        self.engines.append(engine)
+        sa.event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+        sa.event.listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    def remove(self):
+        """ stop listening to the engines """
+        for engine in self.engines:
+            sa.event.remove(engine, 'before_cursor_execute', self.before_cursor_execute)
+            sa.event.remove(engine, 'after_cursor_execute', self.after_cursor_execute)
+        self.engines = []
+
+    def is_timing(self):
+        return True
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if not self.is_timing():
+            return
+        conn.info.setdefault(self._start_key, []).append(time.time())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if not self.is_timing():
+            return
+        start_times = conn.info.get(self._start_key)
+        if not start_times:
+            # timing started while the statement was executing
+            return
+        duration = time.time() - start_times.pop()
+        self.statement_done(conn, cursor, statement, parameters, context, executemany, duration)
+
+    def statement_done(self, conn, cursor, statement, parameters, context, executemany,
+                       duration):
+        raise NotImplementedError
+
+
+class QueryInstrument(CursorTimer):
+    """
+        Records the statements an engine executes in the QueryStats started on
+        the current thread.  Statements executed on a thread without started
+        stats cost one attribute lookup.
+
+            instrument = QueryInstrument(engine)
+            stats = instrument.start()
+            ...
+            instrument.stop()
+    """
+    stats_class = QueryStats
+
+    def __init__(self, engine=None, slowest_count=5):
+        self.slowest_count = slowest_count
+        self._local = threading.local()
+        CursorTimer.__init__(self, engine)
+
+    @property
+    def current(self):
+        return getattr(self._local, 'stats', None)
+
+    def start(self):
+        stats = self.stats_class(self.slowest_count)
+        self._local.stats = stats
+        return stats
+
+    def stop(self):
+        stats = self.current
+        self._local.stats = None
+        return stats
+
+    def is_timing(self):
+        return self.current is not None
+
+    def statement_done(self, conn, cursor, statement, parameters, context, executemany,
+                       duration):
+        self.current.record(statement, duration, cursor.rowcount)
+
+
+class SlowQuery(object):
+    """
+        sql: the statement with its bind values rendered inline when that is
+            possible, otherwise the same as `statement`
+        statement: the statement as sent to the DBAPI
+        parameters: the bind values sent with it
+        duration: the seconds it took to execute
+        stack: list of (filename, line number, function name, source) tuples
+            for the calling code, innermost last
+        plan: rows returned by EXPLAIN for the statement, or None
+    """
+    def __init__(self, sql, statement, parameters, duration, stack, plan=None):
+        self.sql = sql
+        self.statement = statement
+        self.parameters = parameters
+        self.duration = duration
+        self.stack = stack
+        self.plan = plan
+
+    def __str__(self):
+        lines = ['slow query (%.4f seconds):' % self.duration, self.sql]
+        if self.sql == self.statement:
+            lines.append('parameters: %r' % (self.parameters, ))
+        if self.plan is not None:
+            lines.append('plan:')
+            lines.extend('    %s' % (row, ) for row in self.plan)
+        lines.append('stack:')
+        lines.extend(line.rstrip('\n') for line in traceback.format_list(self.stack))
+        return '\n'.join(lines)
+
+
+class SlowQueryLog(CursorTimer):
+    """
+        Reports the statements an engine executes that take `threshold` seconds
+        or longer.  Each one is passed to `callback` as a SlowQuery or, without
+        a callback, logged as a warning to the "sqlalchemybwc.slow_queries"
+        logger, which writes to the rotating `log_file` when one is given.
+
+        With `explain`, the plan of a slow SELECT is captured by running it
+        again with the dialect's prefix from `explain_prefixes`, on the same
+        connection.  EXPLAIN ANALYZE on PostgreSQL executes the query a second
+        time to get actual row counts and timings, so SELECTs that lock rows
+        or call nextval() get the prefix from `explain_only_prefixes` instead.
+        On the `explain_savepoint_dialects`, the EXPLAIN runs in a SAVEPOINT
+        that is rolled back, so a failing EXPLAIN does not abort the
+        transaction of the connection.
+    """
+    explain_prefixes = {
+        'postgresql': 'EXPLAIN ANALYZE ',
+        'sqlite': 'EXPLAIN QUERY PLAN ',
+        'mysql': 'EXPLAIN ',
+    }
+    explain_only_prefixes = {
+        'postgresql': 'EXPLAIN ',
+    }
+    explain_savepoint_dialects = ('postgresql', )
+    # the number of calling frames kept with each slow query
+    stack_limit = 15
+    log_max_bytes = 10 * 1024 * 1024
+    log_backup_count = 5
+
+    def __init__(self, engine, threshold, explain=False, log_file=None, callback=None):
+        self.threshold = threshold
+        self.explain = explain
+        self.callback = callback
+        if log_file:
+            self.add_file_handler(log_file)
+        CursorTimer.__init__(self, engine)
+
+    def add_file_handler(self, log_file):
+        log_file = os.path.abspath(log_file)
+        for handler in slow_query_log.handlers:
+            if getattr(handler, 'baseFilename', None) == log_file:
+                return
+        handler = RotatingFileHandler(log_file, maxBytes=self.log_max_bytes,
+                                      backupCount=self.log_backup_count)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        slow_query_log.addHandler(handler)
+
+    def statement_done(self, conn, cursor, statement, parameters, context, executemany,
+                       duration):
+        if duration < self.threshold:
+            return
+        plan = None
+        if self.explain and not executemany:
+            plan = self.explain_plan(conn, statement, parameters)
+        slow = SlowQuery(self.render(conn, statement, context), statement, parameters,
+                         duration, self.call_stack(), plan)
+        if self.callback is not None:
+            self.callback(slow)
+        else:
+            slow_query_log.warning('%s', slow)
+
+    def render(self, conn, statement, context):
+        compiled = getattr(context, 'compiled', None)
+        if compiled is None or not context.compiled_parameters:
+            return statement
+        try:
+            return render_literal_sql(compiled.statement, conn.dialect,
+                                      context.compiled_parameters[0], compiled.column_keys)
+        except Exception:
+            # not every type can be rendered as a literal
+            return statement
+
+    def call_stack(self):
+        stack = [
+            frame for frame in traceback.extract_stack()
+            if not frame[0].startswith(_stack_skip_paths)
+        ]
+        return stack[-self.stack_limit:]
+
+    def explain_sql(self, dialect_name, statement):
+        """ returns the EXPLAIN statement for a SELECT, or None """
+        prefix = self.explain_prefixes.get(dialect_name)
+        if prefix is None or statement.lstrip()[:6].upper() != 'SELECT':
+            return None
+        if _side_effects_re.search(statement):
+            prefix = self.explain_only_prefixes.get(dialect_name, prefix)
+        return prefix + statement
+
+    def explain_plan(self, conn, statement, parameters):
+        explain_sql = self.explain_sql(conn.dialect.name, statement)
+        if explain_sql is None:
+            return None
+        savepoint = conn.dialect.name in self.explain_savepoint_dialects
+        # a raw DBAPI cursor so the EXPLAIN itself is not timed
+        cursor = conn.connection.cursor()
+        try:
+            if savepoint:
+                cursor.execute('SAVEPOINT sqlalchemybwc_explain')
+            try:
+                cursor.execute(explain_sql, parameters)
+                return [tuple(row) for row in cursor.fetchall()]
+            finally:
+                if savepoint:
+                    cursor.execute('ROLLBACK TO SAVEPOINT sqlalchemybwc_explain')
+                    cursor.execute('RELEASE SAVEPOINT sqlalchemybwc_explain')
+        except Exception as e:
+            return ['EXPLAIN failed: %s' % e]
+        finally:
+            cursor.close()
@@ -1,10 +1,43 @@
+import logging
+import os
+import sys
+import threading
+import time
+import weakref
+
+from blazeweb.events import signal
 from blazeweb.globals import settings, rg
 from blazeweb.hierarchy import visitmods
 from blazeweb.utils import registry_has_object
 from paste.registry import StackedObjectProxy
+import six
 from sqlalchemy import engine_from_config, MetaData
 from sqlalchemy.orm import sessionmaker, scoped_session, Session
 
+from .instrumentation import QueryInstrument, SlowQueryLog, format_repeated
+from .pool import add_fork_check, add_pre_ping, add_sqlite_transactions, pool_options, \
+    pool_capacity, PoolStats, shares_connection, warm_up
+from .routing import ReplicaSet, RoutingSession
+
+log = logging.getLogger(__name__)
+
+# containers set up for a forked child as soon as it is forked.  Without
+# os.register_at_fork (Python < 3.7), they compare PIDs when used instead.
+_containers = weakref.WeakSet()
+_check_pid = not hasattr(os, 'register_at_fork')
+
+
+def _after_fork_in_child():
+    for container in list(_containers):
+        # the child has only one thread, a lock held by another thread of
+        # the parent would never be released
+        container._lock = threading.RLock()
+        container.after_fork()
+
+
+if not _check_pid:
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
 db = StackedObjectProxy(name="db")
 
 
@@ -39,23 +72,236 @@ class DebugSession(Session):
             print('<<<C')
 
 
+class SessionView(object):
+    """
+        A container that uses the given scoped session instead of its own.
+        Pushed onto `db` in threads doing work for somebody else.
+    """
+    def __init__(self, container, Session):
+        self._container = container
+        self.Session = Session
+
+    @property
+    def sess(self):
+        return self.Session
+
+    def __getattr__(self, name):
+        return getattr(self._container, name)
+
+
 class SQLAlchemyContainer(object):
+    """
+        Holds the engine, metadata and scoped sessions of a DB connection.
+
+        The engine (and any replica engines) are created the first time they,
+        or a session, are needed, so building the WSGI stack or running a task
+        that doesn't touch the DB never imports a DBAPI module or builds a
+        pool.  Callables appended to engine_setup are called with the engine,
+        and with each replica engine, as soon as they are created.
+
+        A process forked after the engine was created, like a pre-fork server
+        worker, gets new pools and scoped sessions, see after_fork().  What
+        the parent created is kept, not closed, so the parent's connections
+        are never touched by the child.
+    """
+    # default thread limit of parallel() when the pool's size is not limited
+    parallel_max_workers = 8
 
     def __init__(self, db_settings):
-        if db_settings.url:
-            self.engine = engine_from_config(dict(db_settings), prefix='')
-        else:
-            self.engine = None
+        self.db_settings = db_settings
+        self.sa_settings = settings.components.sqlalchemy
+        self.use_split_sessions = self.sa_settings.use_split_sessions
+        self.pool_stats = None
+        self.engine_setup = []
+        # seconds spent on startup work, by name, for startup profiling
+        self.timings = {}
         self.meta = MetaData()
-        self.Session = self.make_session()
-        if settings.components.sqlalchemy.use_split_sessions:
-            self.AppLevelSession = self.make_session()
+        self._engine = None
+        self._replicas = None
+        self._sessions = {}
+        self._model_loader = None
+        # set once the loader has returned, read without taking the lock
+        self._models_loaded = False
+        self._models_loading = False
+        self._lock = threading.RLock()
+        self._pid = os.getpid()
+        # the parent process's pools and sessions, see after_fork()
+        self._parent_objects = []
+        # the scoped session `sess` returns, cached per thread, see sess
+        self._local = threading.local()
+        _containers.add(self)
+
+    @property
+    def engine(self):
+        if self._pid != os.getpid():
+            self.after_fork()
+        if self._engine is None and self.db_settings.url:
+            with self._lock:
+                if self._engine is None:
+                    self._create_engines()
+        return self._engine
+
+    @property
+    def replicas(self):
+        # the replicas are created with the engine
+        return self._replicas if self.engine is not None else None
+
+    def _create_engines(self):
+        start = time.time()
+        engine = self.make_engine(self.db_settings)
+        replica_urls = self.db_settings.get('replica_urls')
+        if replica_urls:
+            self._replicas = ReplicaSet(
+                [self.make_engine(self.db_settings, url) for url in replica_urls],
+                self.sa_settings.replica_strategy
+            )
+        replicas = self._replicas.engines if self._replicas is not None else []
+        for setup in self.engine_setup:
+            for each in [engine] + replicas:
+                setup(each)
+        # assigned last so other threads never see an engine still being set up
+        self._engine = engine
+        self.record_timing('engine', start)
+        self.warm_up()
+
+    def _all_engines(self):
+        if self._engine is None:
+            return []
+        if self._replicas is None:
+            return [self._engine]
+        return [self._engine] + self._replicas.engines
+
+    def after_fork(self):
+        """
+            Gives this process its own pools and scoped sessions and warms up
+            the new pool.  On Python 3.7+ it is called as soon as the process
+            is forked.  Before that, it is called when the container is first
+            used in the new process, so a server forking workers should call
+            it from its post-fork hook for the pool to be warm before the
+            first request.
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            for engine in self._all_engines():
+                # Engine.dispose() would close the connections the parent is
+                # using, so the old pool is only replaced, and kept referenced
+                # so garbage collection doesn't close its connections either
+                self._parent_objects.append(engine.pool)
+                engine.pool = engine.pool.recreate()
+            self._parent_objects.extend(self._sessions.values())
+            self._sessions = {}
+            self._local = threading.local()
+            if self.pool_stats is not None:
+                self.pool_stats.reset()
+            if self._replicas is not None:
+                self._replicas.reset()
+            self._pid = os.getpid()
+            if self._engine is not None:
+                self.warm_up()
+
+    def warm_up(self):
+        """ opens pool_warm_up connections so the first requests don't wait for them """
+        count = self.sa_settings.pool_warm_up
+        if not count:
+            return
+        start = time.time()
+        try:
+            warm_up(self._engine, count)
+        except Exception as e:
+            log.warning('connection pool warm up failed: %s', e)
+        self.record_timing('warm_up', start)
+
+    def record_timing(self, name, start):
+        self.timings[name] = time.time() - start
+        log.debug('%s took %.4f seconds', name, self.timings[name])
+
+    def _scoped_session(self, name):
+        if self._pid != os.getpid():
+            self.after_fork()
+        if name not in self._sessions:
+            with self._lock:
+                if name not in self._sessions:
+                    self._sessions[name] = self.make_session()
+        return self._sessions[name]
 
-    def make_session(self, dbg_label=None):
+    @property
+    def Session(self):
+        return self._scoped_session('Session')
+
+    @property
+    def AppLevelSession(self):
+        return self._scoped_session('AppLevelSession')
+
+    def remove_session(self):
+        """ removes the request's session, if the scoped session was ever used """
+        if self._pid != os.getpid():
+            self.after_fork()
+        if 'Session' in self._sessions:
+            self._sessions['Session'].remove()
+        if self.use_split_sessions:
+            # the thread may be used outside a request next
+            self._local.__dict__.pop('sess', None)
+
+    def set_model_loader(self, loader):
+        """ `loader` will be called by load_models() the first time it is called """
+        with self._lock:
+            self._model_loader = loader
+            self._models_loaded = False
+
+    def load_models(self):
+        """
+            Imports the model modules if they were left to load lazily.  Tasks
+            and code using db.meta outside of a request should call this first.
+
+            Other threads calling it while the models are imported wait for
+            them.  If the loader raises, the next call tries again.
+        """
+        if self._models_loaded:
+            return
+        with self._lock:
+            # the models imported by the loader may call this again
+            if self._models_loaded or self._models_loading:
+                return
+            if self._model_loader is not None:
+                start = time.time()
+                self._models_loading = True
+                try:
+                    self._model_loader()
+                finally:
+                    self._models_loading = False
+                self._model_loader = None
+                self.record_timing('models', start)
+            self._models_loaded = True
+
+    def make_engine(self, db_settings, replica_url=None):
+        sa_settings = self.sa_settings
+        config = dict(db_settings)
+        config.pop('replica_urls', None)
+        if replica_url is not None:
+            config['url'] = replica_url
+        engine = engine_from_config(config, prefix='', **pool_options(config, sa_settings))
+        if engine.dialect.name == 'sqlite' and engine.dialect.driver == 'pysqlite':
+            add_sqlite_transactions(engine)
+        # before the pre-ping, which must not use the parent's connection
+        add_fork_check(engine)
+        if sa_settings.pool_pre_ping:
+            add_pre_ping(engine)
+        if sa_settings.pool_stats and replica_url is None:
+            self.pool_stats = PoolStats(engine)
+        return engine
+
+    def make_session(self, dbg_label=None, scopefunc=None):
         sm_kwargs = {
             'bind': self.engine,
         }
-        if dbg_label:
+        if self.replicas is not None:
+            sess_inst = sessionmaker(
+                class_=RoutingSession,
+                replicas=self.replicas,
+                **sm_kwargs
+            )
+        elif dbg_label:
             sess_inst = sessionmaker(
                 class_=DebugSession,
                 dbg_label=dbg_label,
@@ -63,16 +309,115 @@ class SQLAlchemyContainer(object):
             )
         else:
             sess_inst = sessionmaker(**sm_kwargs)
-        return scoped_session(sess_inst)
+        return scoped_session(sess_inst, scopefunc=scopefunc)
 
     def get_scoped_session_class(self):
-        if settings.components.sqlalchemy.use_split_sessions and not registry_has_object(rg):
+        if self.use_split_sessions and not registry_has_object(rg):
             return self.AppLevelSession
         return self.Session
 
     @property
     def sess(self):
-        return self.get_scoped_session_class()
+        # this is on the path of every MethodsMixin helper call, so the scoped
+        # session is looked up once and cached for the thread, or the request
+        # when using split sessions, as only a request changes which it is
+        if _check_pid and self._pid != os.getpid():
+            self.after_fork()
+        try:
+            return self._local.sess
+        except AttributeError:
+            Session = self.get_scoped_session_class()
+            if not self.use_split_sessions:
+                self._local.sess = Session
+            return Session
+
+    def begin_request(self):
+        """ called by SQLAlchemyApp at the start of a request """
+        self._local.sess = self.Session
+
+    def parallel(self, *calls, **kwargs):
+        """
+            Runs independent read callables at the same time, each in its own
+            thread with its own session and pooled connection, and returns
+            their results in the same order:
+
+                types, statuses, total = db.parallel(
+                    CustomerType.list_active,
+                    Status.list_active,
+                    Order.count,
+                )
+
+            If calls raise, the exception of the first one is raised after all
+            have finished.  The calls run outside the request, so they should
+            only use `db`, not other request or app globals, and instances
+            they return are detached from their (closed) sessions.
+
+            max_workers: limits the threads used.  Defaults to one per call,
+                but no more than the pool can give connections to while the
+                current thread holds one, or parallel_max_workers for pools
+                without a limit.
+
+            When the engine (or a replica) uses a StaticPool or a
+            SingletonThreadPool, e.g. for in-memory SQLite, threads can not
+            have connections of their own, so the calls run one after another
+            in the current thread, on its session.  A session of their own
+            would share the current session's connection and roll back its
+            uncommitted writes when removed.
+        """
+        max_workers = kwargs.pop('max_workers', None)
+        if kwargs:
+            raise TypeError('unexpected keyword arguments: %s' % ', '.join(kwargs))
+        results = [None] * len(calls)
+        errors = [None] * len(calls)
+
+        def run(index, call):
+            try:
+                results[index] = call()
+            except Exception:
+                errors[index] = sys.exc_info()
+
+        engine = self.engine
+        if engine is not None and any(shares_connection(e) for e in self._all_engines()):
+            for index, call in enumerate(calls):
+                run(index, call)
+            return self._parallel_results(results, errors)
+
+        if max_workers is None:
+            capacity = pool_capacity(engine) if engine is not None else None
+            max_workers = self.parallel_max_workers if capacity is None else capacity - 1
+        max_workers = max(1, min(max_workers, len(calls)))
+        Session = self._scoped_session('ParallelSession')
+        pending = iter(enumerate(calls))
+        pending_lock = threading.Lock()
+
+        def worker():
+            view = SessionView(self, Session)
+            db._push_object(view)
+            try:
+                while True:
+                    with pending_lock:
+                        index, call = next(pending, (None, None))
+                    if call is None:
+                        return
+                    try:
+                        run(index, call)
+                    finally:
+                        Session.remove()
+            finally:
+                db._pop_object(view)
+
+        threads = [threading.Thread(target=worker) for _ in range(max_workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self._parallel_results(results, errors)
+
+    def _parallel_results(self, results, errors):
+        for error in errors:
+            if error is not None:
+                six.reraise(*error)
+        return results
 
 
 class SQLAlchemyApp(object):
@@ -87,13 +432,40 @@ class SQLAlchemyApp(object):
         self.container = SQLAlchemyContainer(self.db_settings)
         self.sop_obj._push_object(self.container)
 
+        self.query_instrument = None
+        sa_settings = self.container.sa_settings
+        self.nplusone_threshold = sa_settings.nplusone_threshold
+        self.nplusone_action = sa_settings.nplusone_action
+        wants_stats = sa_settings.instrument_queries or self.nplusone_threshold is not None
+        if wants_stats and self.db_settings.url:
+            self.query_instrument = QueryInstrument(None, sa_settings.instrument_slowest)
+            self.container.engine_setup.append(self.query_instrument.listen)
+
+        self.slow_query_log = None
+        if sa_settings.slow_query_threshold is not None and self.db_settings.url:
+            self.slow_query_log = SlowQueryLog(
+                None,
+                sa_settings.slow_query_threshold,
+                explain=sa_settings.slow_query_explain,
+                log_file=sa_settings.slow_query_log_file,
+                callback=sa_settings.slow_query_callback,
+            )
+            self.container.engine_setup.append(self.slow_query_log.listen)
+
         # if using multiple DB connections, only the one highest in the wsgi
         # stack should visit the mods.
-        if visit_mods:
-            visitmods('model.orm')
-            visitmods('model.entities')
-            visitmods('model.metadata')
-            visitmods('model.schema')
+        if visit_mods and sa_settings.lazy_visit_mods:
+            self.container.set_model_loader(self.visit_mods)
+        elif visit_mods:
+            start = time.time()
+            self.visit_mods()
+            self.container.record_timing('models', start)
+
+    def visit_mods(self):
+        visitmods('model.orm')
+        visitmods('model.entities')
+        visitmods('model.metadata')
+        visitmods('model.schema')
 
     @property
     def sop_obj(self):
@@ -103,15 +475,49 @@ class SQLAlchemyApp(object):
     def db_settings(self):
         return settings.db
 
+    def check_repeated(self, stats, environ):
+        """
+            Acts on the SELECT statements executed more than nplusone_threshold
+            times.  Returns the repeated statements.
+        """
+        repeated = stats.repeated(self.nplusone_threshold)
+        if repeated and self.nplusone_action == 'log':
+            log.warning('possible N+1 queries for %s %s', environ.get('PATH_INFO'),
+                        format_repeated(repeated, self.nplusone_threshold))
+        elif repeated and self.nplusone_action == 'raise':
+            stats.check_repeated(self.nplusone_threshold)
+        return repeated
+
     def __call__(self, environ, start_response):
+        stats = None
+        if self.query_instrument is not None:
+            stats = environ['sqlalchemybwc.query_stats'] = self.query_instrument.start()
+
         # clear the session after every response cycle
         def response_cycle_teardown():
-            self.container.Session.remove()
+            self.container.remove_session()
+            if self.query_instrument is not None and self.query_instrument.stop() is not None:
+                signal('sqlalchemybwc.request.query_stats').send(stats=stats, environ=environ)
+                if self.nplusone_threshold is not None:
+                    environ['sqlalchemybwc.repeated_queries'] = \
+                        self.check_repeated(stats, environ)
         environ.setdefault('blazeweb.response_cycle_teardown', [])
         environ['blazeweb.response_cycle_teardown'].append(response_cycle_teardown)
 
         # register the db variable for this request/thread
         environ['paste.registry'].register(self.sop_obj, self.container)
+        self.container.load_models()
+        self.container.begin_request()
+
+        if stats is not None and self.nplusone_action == 'header':
+            # the response cycle is over by the time the response starts
+            inner_start_response = start_response
+
+            def start_response(status, headers, exc_info=None):
+                repeated = environ.get('sqlalchemybwc.repeated_queries')
+                if repeated:
+                    headers.append(('X-Repeated-Queries', str(len(repeated))))
+                return inner_start_response(status, headers, exc_info)
 
         # call the inner application
         return self.application(environ, start_response)
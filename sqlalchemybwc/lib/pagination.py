@@ -0,0 +1,151 @@
+"""
+    Pages of records for MethodsMixin.paginate() and .page_where(), and the
+    opaque cursors keyset pagination hands out to get the next page.
+"""
+import base64
+from datetime import date, datetime, time
+from decimal import Decimal
+import json
+
+import six
+import sqlalchemy.sql as sasql
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.expression import ColumnElement, UnaryExpression
+
+_datetime_format = '%Y-%m-%dT%H:%M:%S.%f'
+_date_format = '%Y-%m-%d'
+_time_format = '%H:%M:%S.%f'
+
+
+class InvalidCursor(ValueError):
+    """ a cursor given to paginate() was not made by it, or not for that ordering """
+
+
+class Page(object):
+    """
+        items: the records on the page
+        per_page: the maximum number of records on a page
+        has_next: whether there are records after this page
+        next_cursor: with keyset pagination, the `after` argument that gets
+            the next page, None on the last page
+        page: with offset pagination, the number of this page, from 1
+        total & pages: with offset pagination, the number of records and of
+            pages when the total was asked for, otherwise None
+    """
+    def __init__(self, items, per_page, has_next, next_cursor=None, page=None, total=None):
+        self.items = items
+        self.per_page = per_page
+        self.has_next = has_next
+        self.next_cursor = next_cursor
+        self.page = page
+        self.total = total
+
+    @property
+    def pages(self):
+        if self.total is None:
+            return None
+        return max(1, -(-self.total // self.per_page))
+
+    @property
+    def next_page(self):
+        if self.page is None or not self.has_next:
+            return None
+        return self.page + 1
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __repr__(self):
+        return '<Page items=%s has_next=%s page=%s total=%s>' % (
+            len(self.items), self.has_next, self.page, self.total)
+
+
+def order_columns(order_by):
+    """
+        Returns a list of (column, descending) tuples for the order_by items,
+        which have to be columns, optionally with .asc() or .desc().
+    """
+    columns = []
+    for item in order_by:
+        if hasattr(item, '__clause_element__'):
+            item = item.__clause_element__()
+        descending = False
+        if isinstance(item, UnaryExpression) and item.modifier in (operators.asc_op,
+                                                                   operators.desc_op):
+            descending = item.modifier is operators.desc_op
+            item = item.element
+        if not isinstance(item, ColumnElement) or \
+                (isinstance(item, UnaryExpression) and item.modifier is not None):
+            raise ValueError('keyset pagination can only order by columns, not: %r' % (item, ))
+        columns.append((item, descending))
+    return columns
+
+
+def seek_clause(columns, values):
+    """
+        Returns a clause matching the rows that come after `values` when
+        ordered by `columns`, a list of (column, descending) tuples, i.e.
+        (a > x) OR (a = x AND b > y).  Row value comparisons, (a, b) > (x, y),
+        are not supported by SQLite and MSSQL and can not mix directions.
+    """
+    clauses = []
+    for idx, (col, descending) in enumerate(columns):
+        equals = [c == v for (c, _), v in zip(columns[:idx], values[:idx])]
+        after = col < values[idx] if descending else col > values[idx]
+        clauses.append(sasql.and_(*(equals + [after])))
+    return sasql.or_(*clauses)
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {'datetime': value.strftime(_datetime_format)}
+    if isinstance(value, date):
+        return {'date': value.strftime(_date_format)}
+    if isinstance(value, time):
+        return {'time': value.strftime(_time_format)}
+    if isinstance(value, Decimal):
+        return {'decimal': str(value)}
+    if isinstance(value, six.binary_type):
+        return {'bytes': base64.b64encode(value).decode('ascii')}
+    return value
+
+
+def _decode_value(value):
+    if not isinstance(value, dict):
+        return value
+    kind, text = list(value.items())[0]
+    if kind == 'datetime':
+        return datetime.strptime(text, _datetime_format)
+    if kind == 'date':
+        return datetime.strptime(text, _date_format).date()
+    if kind == 'time':
+        return datetime.strptime(text, _time_format).time()
+    if kind == 'decimal':
+        return Decimal(text)
+    if kind == 'bytes':
+        return base64.b64decode(text.encode('ascii'))
+    raise ValueError('unknown cursor value type: %s' % kind)
+
+
+def encode_cursor(values):
+    """ returns an opaque, URL safe string for the ordering values of a record """
+    data = json.dumps([_encode_value(value) for value in values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, count):
+    """ returns the `count` ordering values of a cursor from encode_cursor() """
+    try:
+        data = base64.urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4))
+        values = json.loads(data.decode('utf-8'))
+        if not isinstance(values, list):
+            raise ValueError
+        values = [_decode_value(value) for value in values]
+    except Exception:
+        raise InvalidCursor('invalid pagination cursor: %r' % (cursor, ))
+    if len(values) != count:
+        raise InvalidCursor('pagination cursor does not match the ordering: %r' % (cursor, ))
+    return values
@@ -0,0 +1,286 @@
+"""
+    Connection pool configuration and statistics for the container's engine.
+"""
+import os
+import threading
+import time
+
+import sqlalchemy as sa
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool, SingletonThreadPool, StaticPool
+
+# upper bounds, in seconds, of the checkout latency histogram buckets
+latency_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+# dialect name -> pool_recycle default.  MySQL closes connections idle for
+# longer than wait_timeout (8 hours by default, often much less on hosted DBs).
+recycle_defaults = {
+    'mysql': 3600,
+}
+
+
+def is_memory_sqlite(url):
+    url = make_url(url)
+    return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+
+def shares_connection(engine):
+    """
+        True when the engine's pool does not give each thread a connection of
+        its own: a StaticPool has a single connection for all threads and a
+        SingletonThreadPool one per thread, which for in-memory SQLite are
+        different databases.
+    """
+    return isinstance(engine.pool, (StaticPool, SingletonThreadPool))
+
+
+def pool_capacity(engine):
+    """
+        The number of connections the engine's pool can have checked out at
+        once, or None when it is not limited.
+    """
+    pool = engine.pool
+    if isinstance(pool, QueuePool) and pool._max_overflow >= 0:
+        return pool.size() + pool._max_overflow
+    return None
+
+
+def pool_options(db_settings, sa_settings):
+    """
+        Returns the create_engine() keyword arguments for the pool settings of
+        the sqlalchemy component.  Pool options already in `db_settings` are
+        left alone so an app can still configure the engine directly.
+
+        An in-memory SQLite DB exists only as long as its connection, so it
+        gets a StaticPool that shares one connection between all threads.
+        Sizing and recycle settings only apply to dialects using a QueuePool.
+    """
+    url = make_url(db_settings['url'])
+    options = {}
+    if is_memory_sqlite(url):
+        options['poolclass'] = StaticPool
+        options['connect_args'] = {'check_same_thread': False}
+    elif issubclass(url.get_dialect().get_pool_class(url), QueuePool):
+        if sa_settings.pool_stats:
+            options['poolclass'] = TimedQueuePool
+        recycle = sa_settings.pool_recycle
+        if recycle is None:
+            recycle = recycle_defaults.get(url.get_backend_name())
+        for arg, value in (
+            ('pool_size', sa_settings.pool_size),
+            ('max_overflow', sa_settings.pool_max_overflow),
+            ('pool_timeout', sa_settings.pool_timeout),
+            ('pool_recycle', recycle),
+        ):
+            if value is not None:
+                options[arg] = value
+    return dict(
+        (arg, value) for arg, value in options.items() if arg not in db_settings
+    )
+
+
+def add_pre_ping(engine):
+    """
+        Tests each connection with a "SELECT 1" when it is checked out of the
+        engine's pool.  A connection that fails the test is discarded and the
+        pool tries again with a new one, so connections dropped by the DB
+        server or a firewall are replaced before a query fails on them.
+    """
+    ping_sql = 'SELECT 1 FROM DUAL' if engine.dialect.name == 'oracle' else 'SELECT 1'
+
+    def ping_connection(dbapi_connection, connection_record, connection_proxy):
+        # a raw cursor keeps the ping out of the engine's execution events
+        try:
+            cursor = dbapi_connection.cursor()
+            cursor.execute(ping_sql)
+            cursor.close()
+        except Exception:
+            raise sa.exc.DisconnectionError()
+    sa.event.listen(engine.pool, 'checkout', ping_connection)
+    return ping_connection
+
+
+def add_fork_check(engine):
+    """
+        Keeps a process from using a pooled connection made by another process,
+        e.g. the parent of a pre-fork worker.  The connection is dropped, not
+        closed, so the socket the parent still uses is left alone, and the pool
+        makes a new one.
+    """
+    def on_connect(dbapi_connection, connection_record):
+        connection_record.info['sqlalchemybwc.pid'] = os.getpid()
+
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        if connection_record.info.get('sqlalchemybwc.pid', os.getpid()) != os.getpid():
+            connection_record.connection = connection_proxy.connection = None
+            raise sa.exc.DisconnectionError(
+                'connection belongs to process %s, attempting to check out in process %s'
+                % (connection_record.info['sqlalchemybwc.pid'], os.getpid())
+            )
+    sa.event.listen(engine.pool, 'connect', on_connect)
+    sa.event.listen(engine.pool, 'checkout', on_checkout)
+
+
+def add_sqlite_transactions(engine):
+    """
+        Lets begin_nested() work with the pysqlite driver, which before Python
+        3.6 commits the open transaction before a SAVEPOINT.  The driver's
+        transaction handling is turned off and, like the driver, a BEGIN is
+        emitted before the first statement of a transaction that is not a
+        SELECT, so reads still do not hold a lock on the DB file.
+    """
+    pending_key = 'sqlalchemybwc.begin_pending'
+
+    def on_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    def on_begin(conn):
+        conn.info[pending_key] = True
+
+    def on_end(conn):
+        conn.info.pop(pending_key, None)
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if conn.info.get(pending_key) and statement.lstrip()[:6].upper() != 'SELECT':
+            del conn.info[pending_key]
+            cursor.execute('BEGIN')
+    sa.event.listen(engine.pool, 'connect', on_connect)
+    sa.event.listen(engine, 'begin', on_begin)
+    sa.event.listen(engine, 'commit', on_end)
+    sa.event.listen(engine, 'rollback', on_end)
+    sa.event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def warm_up(engine, count):
+    """ opens `count` connections so the pool has them ready """
+    connections = []
+    try:
+        for _ in range(count):
+            connections.append(engine.connect())
+    finally:
+        for connection in connections:
+            connection.close()
+
+
+class TimedQueuePool(QueuePool):
+    """
+        A QueuePool that reports how long each checkout takes, including any
+        time spent waiting for a connection to be returned, to its PoolStats.
+    """
+    stats = None
+
+    def connect(self):
+        return self._timed_checkout(QueuePool.connect)
+
+    def unique_connection(self):
+        # used by Engine.connect()
+        return self._timed_checkout(QueuePool.unique_connection)
+
+    def _timed_checkout(self, checkout):
+        start = time.time()
+        try:
+            return checkout(self)
+        except sa.exc.TimeoutError:
+            if self.stats is not None:
+                self.stats.record_timeout()
+            raise
+        finally:
+            if self.stats is not None:
+                self.stats.record_checkout_latency(time.time() - start)
+
+    def recreate(self):
+        pool = QueuePool.recreate(self)
+        pool.stats = self.stats
+        return pool
+
+
+class PoolStats(object):
+    """
+        Health of an engine's connection pool, fed by pool events:
+
+            checked_out: connections currently in use
+            checkouts: connections handed out since the stats started
+            connects: new DBAPI connections made
+            size & overflow: from the pool when it is a QueuePool
+
+        Checkout latency, which includes the time spent waiting for a free
+        connection, and timeouts are recorded when the pool is a
+        TimedQueuePool (pool_stats setting).
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self._lock = threading.Lock()
+        self.reset()
+        sa.event.listen(engine.pool, 'checkout', self.on_checkout)
+        sa.event.listen(engine.pool, 'checkin', self.on_checkin)
+        sa.event.listen(engine.pool, 'connect', self.on_connect)
+        if isinstance(engine.pool, TimedQueuePool):
+            engine.pool.stats = self
+
+    def reset(self):
+        """ start over, e.g. in a new pool """
+        self.checked_out = 0
+        self.checkouts = 0
+        self.connects = 0
+        self.timeouts = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.latency_counts = [0] * (len(latency_buckets) + 1)
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self._lock:
+            self.checked_out += 1
+            self.checkouts += 1
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.checked_out -= 1
+
+    def on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def record_checkout_latency(self, duration):
+        bucket = len(latency_buckets)
+        for index, upper in enumerate(latency_buckets):
+            if duration <= upper:
+                bucket = index
+                break
+        with self._lock:
+            self.latency_total += duration
+            self.latency_max = max(self.latency_max, duration)
+            self.latency_counts[bucket] += 1
+
+    @property
+    def latency_histogram(self):
+        """ list of (bucket upper bound in seconds, checkouts) tuples, the last bound is None """
+        return list(zip(latency_buckets + (None, ), self.latency_counts))
+
+    def as_dict(self):
+        pool = self.engine.pool
+        is_queue_pool = isinstance(pool, QueuePool)
+        timed = sum(self.latency_counts)
+        return {
+            'pool': pool.__class__.__name__,
+            'size': pool.size() if is_queue_pool else None,
+            'overflow': pool.overflow() if is_queue_pool else None,
+            'checked_out': self.checked_out,
+            'checkouts': self.checkouts,
+            'connects': self.connects,
+            'timeouts': self.timeouts,
+            'latency_avg': self.latency_total / timed if timed else None,
+            'latency_max': self.latency_max,
+            'latency_histogram': self.latency_histogram,
+        }
+
+    def remove(self):
+        """ stop listening to the pool """
+        sa.event.remove(self.engine.pool, 'checkout', self.on_checkout)
+        sa.event.remove(self.engine.pool, 'checkin', self.on_checkin)
+        sa.event.remove(self.engine.pool, 'connect', self.on_connect)
+        if getattr(self.engine.pool, 'stats', None) is self:
+            self.engine.pool.stats = None
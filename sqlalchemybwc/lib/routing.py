@@ -0,0 +1,103 @@
+"""
+    Sends the SELECTs of a session to read replicas of the primary DB.
+"""
+import itertools
+import threading
+
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.expression import Select
+
+# session.info key set when a session should only use the primary for the
+# rest of its life, i.e. the rest of the request
+use_primary_key = 'sqlalchemybwc.use_primary'
+# session.info key of the replica the session reads from
+replica_key = 'sqlalchemybwc.replica'
+
+
+def use_primary(sess):
+    """
+        Makes the session send everything to the primary from now on.  Works
+        with scoped sessions and sessions that do not route.
+    """
+    sess.info[use_primary_key] = True
+
+
+class ReplicaSet(object):
+    """
+        Picks the replica engine for a read.
+
+        strategy: 'round_robin' goes through the replicas in order,
+            'least_connections' picks the replica with the fewest connections
+            checked out of its pool.
+    """
+    strategies = ('round_robin', 'least_connections')
+
+    def __init__(self, engines, strategy='round_robin'):
+        if strategy not in self.strategies:
+            raise ValueError('replica strategy must be one of: %s' % ', '.join(self.strategies))
+        self.engines = list(engines)
+        self.strategy = strategy
+        self._lock = threading.Lock()
+        self._cycle = itertools.cycle(self.engines)
+        self.reset()
+        if strategy == 'least_connections':
+            for engine in self.engines:
+                self._count_connections(engine)
+
+    def reset(self):
+        """ start counting connections over, e.g. in new pools """
+        self.checked_out = dict((engine, 0) for engine in self.engines)
+
+    def _count_connections(self, engine):
+        def on_checkout(dbapi_connection, connection_record, connection_proxy):
+            with self._lock:
+                self.checked_out[engine] += 1
+
+        def on_checkin(dbapi_connection, connection_record):
+            with self._lock:
+                self.checked_out[engine] -= 1
+        sa.event.listen(engine.pool, 'checkout', on_checkout)
+        sa.event.listen(engine.pool, 'checkin', on_checkin)
+
+    def choose(self):
+        with self._lock:
+            if self.strategy == 'least_connections':
+                return min(self.engines, key=lambda engine: self.checked_out[engine])
+            return next(self._cycle)
+
+
+class RoutingSession(Session):
+    """
+        A Session that runs plain SELECTs on a replica from its ReplicaSet and
+        everything else on the primary, its bind.  The replica is chosen on the
+        first read and used for all of the session's reads, so a request holds
+        one replica connection and does not see the lag of several replicas.
+        Once the session flushes,
+        executes any other statement (e.g. an UPDATE from execute() or
+        Query.update()), or use_primary() is called on it (as @transaction
+        does), it sticks to the primary so reads see the session's own writes.
+    """
+    def __init__(self, *args, **kwargs):
+        self.replicas = kwargs.pop('replicas')
+        Session.__init__(self, *args, **kwargs)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._reads_from_replica(clause):
+            replica = self.info.get(replica_key)
+            if replica is None:
+                replica = self.info[replica_key] = self.replicas.choose()
+            return replica
+        if clause is not None:
+            # a write, a locking SELECT or text SQL that may write
+            use_primary(self)
+        return Session.get_bind(self, mapper, clause)
+
+    def _reads_from_replica(self, clause):
+        if self._flushing or self.info.get(use_primary_key):
+            return False
+        return isinstance(clause, Select) and clause._for_update_arg is None
+
+    def _flush(self, objects=None):
+        use_primary(self)
+        return Session._flush(self, objects)
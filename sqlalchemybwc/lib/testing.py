@@ -1,5 +1,11 @@
+from contextlib import contextmanager
+
+from blazeutils.helpers import tolist
 import sqlalchemy.orm
 
+from compstack.sqlalchemy import db
+from compstack.sqlalchemy.lib.instrumentation import QueryInstrument, render_literal_sql
+
 
 def query_to_str(statement, bind=None):
     """
@@ -19,18 +25,36 @@ def query_to_str(statement, bind=None):
         raise Exception('bind param (engine or connection object) required when using with an '
                         'unbound statement')
 
-    dialect = bind.dialect
-    compiler = statement._compiler(dialect)
-
-    class LiteralCompiler(compiler.__class__):
-        def visit_bindparam(
-                self, bindparam, within_columns_clause=False,
-                literal_binds=False, **kwargs
-        ):
-            return super(LiteralCompiler, self).render_literal_bindparam(
-                bindparam, within_columns_clause=within_columns_clause,
-                literal_binds=literal_binds, **kwargs
-            )
-
-    compiler = LiteralCompiler(dialect, statement)
-    return 'TESTING ONLY BIND: ' + compiler.process(statement)
+    return 'TESTING ONLY BIND: ' + render_literal_sql(statement, bind.dialect)
+
+
+@contextmanager
+def detect_nplusone(threshold=5, engine=None):
+    """
+        Fails with NPlusOneError when a SELECT statement is executed more than
+        `threshold` times inside the block, which usually means a relationship
+        is being lazy loaded in a loop:
+
+            with detect_nplusone(threshold=2) as stats:
+                for blog in Blog.list():
+                    blog.comments
+
+        engine: the engine, or list of engines, to watch.  By default, db.engine
+            and its read replicas.
+    """
+    if engine is None:
+        engines = [db.engine]
+        if db.replicas is not None:
+            engines.extend(db.replicas.engines)
+    else:
+        engines = tolist(engine)
+    instrument = QueryInstrument(slowest_count=0)
+    for engine in engines:
+        instrument.listen(engine)
+    stats = instrument.start()
+    try:
+        yield stats
+    finally:
+        instrument.stop()
+        instrument.remove()
+    stats.check_repeated(threshold)
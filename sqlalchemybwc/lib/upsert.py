@@ -0,0 +1,98 @@
+"""
+    An INSERT construct that updates the existing row when it conflicts with a
+    unique constraint or index, rendered with the DB's native statement:
+
+        postgresql & sqlite: INSERT ... ON CONFLICT (...) DO UPDATE SET ...
+        mssql: MERGE ... WHEN MATCHED THEN UPDATE ... WHEN NOT MATCHED THEN INSERT ...
+
+    PostgreSQL 9.5+ and SQLite 3.24+ are required for ON CONFLICT support.  An
+    older SQLite library, as shipped with many Python builds, gets a
+    CompileError instead of a syntax error from the DB.
+"""
+from sqlalchemy.exc import CompileError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql import crud
+from sqlalchemy.sql.expression import ClauseElement, Insert
+
+
+class Upsert(Insert):
+    """
+        table: the Table to insert into
+        conflict_cols: names of the columns making up the unique constraint or
+            index that identifies an existing row
+        update_cols: names of the columns to update on an existing row.  When
+            empty, existing rows are left alone.
+    """
+    def __init__(self, table, conflict_cols, update_cols, **kwargs):
+        # we never need the primary key back, and rendering it inline keeps
+        # the statement usable with executemany on every dialect
+        kwargs.setdefault('inline', True)
+        Insert.__init__(self, table, **kwargs)
+        self.conflict_cols = list(conflict_cols)
+        self.update_cols = list(update_cols)
+        self._post_values_clause = OnConflict(self.conflict_cols, self.update_cols)
+
+
+class OnConflict(ClauseElement):
+    def __init__(self, conflict_cols, update_cols):
+        self.conflict_cols = conflict_cols
+        self.update_cols = update_cols
+
+
+@compiles(OnConflict)
+def _compile_on_conflict(element, compiler, **kw):
+    raise CompileError('upsert does not yet support dialect: %s' % compiler.dialect.name)
+
+
+@compiles(OnConflict, 'sqlite')
+def _compile_on_conflict_sqlite(element, compiler, **kw):
+    dbapi = compiler.dialect.dbapi
+    # a dialect created only to compile SQL has no DBAPI to check
+    version = getattr(dbapi, 'sqlite_version_info', None)
+    if version is not None and version < (3, 24):
+        raise CompileError('upsert requires SQLite 3.24 or later, not %s'
+                           % '.'.join(str(part) for part in version))
+    return _compile_on_conflict_postgresql_sqlite(element, compiler, **kw)
+
+
+@compiles(OnConflict, 'postgresql')
+def _compile_on_conflict_postgresql_sqlite(element, compiler, **kw):
+    quote = compiler.preparer.quote
+    text = 'ON CONFLICT (%s) ' % ', '.join(quote(col) for col in element.conflict_cols)
+    if not element.update_cols:
+        return text + 'DO NOTHING'
+    return text + 'DO UPDATE SET %s' % ', '.join(
+        '%s = excluded.%s' % (quote(col), quote(col)) for col in element.update_cols
+    )
+
+
+@compiles(Upsert, 'mssql')
+def _compile_upsert_mssql(element, compiler, **kw):
+    # MERGE has no VALUES list of its own, so the bind params (and defaults)
+    # for the insert are collected the same way SQLCompiler.visit_insert() does
+    compiler.stack.append({
+        'correlate_froms': set(),
+        'asfrom_froms': set(),
+        'selectable': element,
+    })
+    crud_params = crud._setup_crud_params(compiler, element, crud.ISINSERT, **kw)
+    compiler.stack.pop(-1)
+
+    quote = compiler.preparer.quote
+    names = [quote(col.name) for col, _ in crud_params]
+    text = 'MERGE INTO %s WITH (HOLDLOCK) AS target USING (SELECT %s) AS source ON %s' % (
+        compiler.preparer.format_table(element.table),
+        ', '.join('%s AS %s' % (value, name) for name, (_, value) in zip(names, crud_params)),
+        ' AND '.join(
+            'target.%s = source.%s' % (quote(col), quote(col)) for col in element.conflict_cols
+        ),
+    )
+    if element.update_cols:
+        text += ' WHEN MATCHED THEN UPDATE SET %s' % ', '.join(
+            'target.%s = source.%s' % (quote(col), quote(col)) for col in element.update_cols
+        )
+    text += ' WHEN NOT MATCHED THEN INSERT (%s) VALUES (%s);' % (
+        ', '.join(names),
+        ', '.join('source.%s' % name for name in names),
+    )
+    return text
@@ -4,6 +4,8 @@ from compstack.sqlalchemy.lib.sqlitefktg4sa import auto_assign
 
 def action_10_create_db_objects():
     """ initialize the database """
+    db.load_models()
+
     # create foreign key triggers for SQLite
     auto_assign(db.meta, db.engine)
 
@@ -19,6 +19,7 @@ class Default(DefaultSettings):
 
         self.add_route('/', 'Index')
         self.add_route('/beaker-test', 'BeakerTest')
+        self.add_route('/repeated-queries', 'RepeatedQueries')
 
 
 class Dev(Default):
@@ -51,6 +52,19 @@ class SplitSessionsTest(Default):
         self.components.sqlalchemy.use_split_sessions = True
 
 
+class InstrumentedTest(Default):
+    def init(self):
+        Default.init(self)
+        self.apply_test_settings()
+
+        self.db.url = 'sqlite://'
+
+        self.components.sqlalchemy.instrument_queries = True
+        self.components.sqlalchemy.instrument_slowest = 2
+        self.components.sqlalchemy.nplusone_threshold = 2
+        self.components.sqlalchemy.nplusone_action = 'header'
+
+
 class BeakerSessionTest(Default):
     def init(self):
         Default.init(self)
@@ -1,4 +1,5 @@
 import sqlalchemy as sa
+import sqlalchemy.orm as saorm
 
 from blazeutils.strings import randchars
 
@@ -15,6 +16,8 @@ class Blog(Base, DefaultMixin):
     # running into problems on the db side by trying to update an identity
     # or PK column
     ident = sa.Column(sa.String(12), unique=True, nullable=False, default=lambda: randchars())
+    # the FK on comments keeps blogs with comments from being deleted
+    comments = saorm.relationship('Comment', backref='blog', passive_deletes='all')
 
 
 class Comment(Base, DefaultMixin):
@@ -56,6 +56,10 @@ class Car(Base, DefaultMixin):
     model = sa.Column(sa.Unicode(255), nullable=False)
     year = sa.Column(sa.Integer, nullable=False)
 
+    @property
+    def title(self):
+        return u'%s %s' % (self.make, self.model)
+
     def __repr__(self):
         return '<Car %s, %s, %s>' % (self.make, self.model, self.year)
 
@@ -80,10 +84,29 @@ class Truck(Base, DefaultMixin):
 sa.Index('uidx_sabwp_truck_makemodel', Truck.make, Truck.model, unique=True)
 
 
+class Vehicle(Base, DefaultMixin):
+    __tablename__ = 'sabwp_vehicles'
+
+    kind = sa.Column(sa.Unicode(20), nullable=False)
+    name = sa.Column(sa.Unicode(255), nullable=False)
+
+    __mapper_args__ = {'polymorphic_on': kind, 'polymorphic_identity': u'vehicle'}
+
+
+class Motorcycle(Vehicle):
+    __mapper_args__ = {'polymorphic_identity': u'motorcycle'}
+
+
 class CustomerType(Base, LookupMixin):
     __tablename__ = 'sabwp_customer_types'
 
 
+class CachedCustomerType(Base, LookupMixin):
+    __tablename__ = 'sabwp_cached_customer_types'
+
+    lookup_cache_ttl = 60
+
+
 class HasUniqueValidation(Base, DefaultMixin):
     __tablename__ = 'sabwp_has_unique_val'
 
@@ -1,4 +1,5 @@
 from blazeutils.strings import randchars
+from blazeweb.events import signal
 from blazeweb.globals import ag, settings
 from blazeweb.tasks import run_tasks
 from blazeweb.testing import TestApp
@@ -8,6 +9,7 @@ from nose.tools import eq_
 import sqlalchemy as sa
 from sqlalchemy.orm.exc import DetachedInstanceError
 from sqlalchemybwc import db
+from sqlalchemybwc.lib.instrumentation import QueryStats
 
 from sqlalchemybwc_ta.application import make_wsgi
 from sqlalchemybwc_ta.model.orm import Car
@@ -57,6 +59,37 @@ class TestTemplates(object):
         ta.get('/')
         assert c.make
 
+    def test_query_instrumentation(self):
+        wsgiapp = make_wsgi('InstrumentedTest')
+        ta = TestApp(wsgiapp)
+        run_tasks('init-db:~test')
+
+        sent = []
+
+        def receiver(sender, stats, environ):
+            sent.append((stats, environ))
+
+        signal('sqlalchemybwc.request.query_stats').connect(receiver)
+        try:
+            ta.get('/')
+        finally:
+            signal('sqlalchemybwc.request.query_stats').disconnect(receiver)
+
+        eq_(len(sent), 1)
+        stats, environ = sent[0]
+        assert isinstance(stats, QueryStats)
+        assert environ['sqlalchemybwc.query_stats'] is stats
+        # the index view adds a Car
+        assert stats.statements >= 1
+        assert stats.duration > 0
+        assert 1 <= len(stats.slowest) <= 2
+        assert 'INSERT INTO sabwp_cars' in ' '.join(sql for _, sql in stats.slowest)
+
+        # repeated SELECTs are flagged with a response header
+        assert 'X-Repeated-Queries' not in ta.get('/').headers
+        r = ta.get('/repeated-queries')
+        eq_(r.headers['X-Repeated-Queries'], '1')
+
     def test_session_clear_beaker(self):
         # make beaker create a session table. Use the alternate profile to have
         #   a database file, instead of in-memory, where it will get wiped before
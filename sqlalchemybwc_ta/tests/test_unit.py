@@ -1,22 +1,57 @@
+from contextlib import contextmanager
 from pathlib import Path
+import tempfile
+import threading
+import time
 
+from blazeutils.config import QuickSettings
+from blazeutils.helpers import tolist
 from blazeutils.testing import raises
+from nose.plugins.skip import SkipTest
 from nose.tools import eq_
 import six
+import sqlalchemy as sa
+from sqlalchemy.ext import baked
+import sqlalchemy.orm as saorm
 
 from sqlalchemybwc import db
-from sqlalchemybwc.lib.decorators import one_to_none_ncm, \
+from sqlalchemybwc.lib.aio import asyncio, AsyncContainer
+from sqlalchemybwc.lib.decorators import one_to_none_ncm, transaction_ncm, \
     assert_raises_null_or_fk_exc, assert_raises_null_exc, assert_raises_fk_exc
+from sqlalchemybwc.lib.instrumentation import normalize_sql, NPlusOneError, QueryInstrument, \
+    SlowQueryLog, slow_query_log
 from sqlalchemybwc.lib.helpers import is_unique_exc, _is_unique_msg, \
-    _is_unique_error_saval, _is_null_msg, _is_fk_msg, _is_check_const
+    _is_unique_error_saval, _is_null_msg, _is_fk_msg, _is_check_const, _is_retryable_msg, \
+    is_retryable_exc
+from sqlalchemybwc.lib.pool import add_fork_check, add_pre_ping, is_memory_sqlite, pool_options, \
+    pool_capacity, PoolStats, shares_connection, TimedQueuePool, warm_up
+from sqlalchemybwc.lib.middleware import _after_fork_in_child, SQLAlchemyContainer
+from sqlalchemybwc.lib.pagination import InvalidCursor
+from sqlalchemybwc.lib.routing import ReplicaSet, RoutingSession, use_primary
 from sqlalchemybwc.lib.sql import run_app_sql, run_component_sql, SQLLoader
-from sqlalchemybwc.lib.testing import query_to_str
+from sqlalchemybwc.lib.testing import detect_nplusone, query_to_str
 
 from sqlalchemybwc_ta.model.orm import UniqueRecord, OneToNone, Car, \
-    UniqueRecordTwo, Truck, CustomerType, NoDefaults, declarative_base
+    UniqueRecordTwo, Truck, CustomerType, NoDefaults, declarative_base, CachedCustomerType, \
+    Vehicle, Motorcycle
 from sqlalchemybwc_ta.model.entities import Blog, Comment
 
 
+@contextmanager
+def recorded_statements():
+    """ yields the list of the SQL statements executed inside the block """
+    statements = []
+
+    def record_statement(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    sa.event.listen(db.engine, 'before_cursor_execute', record_statement)
+    try:
+        yield statements
+    finally:
+        sa.event.remove(db.engine, 'before_cursor_execute', record_statement)
+
+
 def test_ignore_unique():
     assert UniqueRecord.add(u'test_ignore_unique')
 
@@ -79,6 +114,119 @@ def test_transaction_decorator():
     assert ur.name == u'test_transaction_decorator'
 
 
+def locked_error():
+    return sa.exc.OperationalError('UPDATE ...', {}, Exception('database is locked'))
+
+
+def test_transaction_retries():
+    calls = []
+
+    @transaction_ncm(retries=2, backoff=0.001)
+    def flaky(fail_times):
+        calls.append(True)
+        if len(calls) <= fail_times:
+            raise locked_error()
+        return len(calls)
+
+    eq_(flaky(2), 3)
+
+    del calls[:]
+    try:
+        flaky(3)
+        assert False, 'expected OperationalError'
+    except sa.exc.OperationalError:
+        eq_(len(calls), 3)
+
+    # other errors are not retried
+    calls = []
+
+    @transaction_ncm(retries=2)
+    def broken():
+        calls.append(True)
+        raise ValueError('broken')
+    try:
+        broken()
+        assert False, 'expected ValueError'
+    except ValueError:
+        eq_(len(calls), 1)
+
+
+def test_transaction_savepoint():
+    @transaction_ncm(savepoint=True)
+    def add_inner(model, fail=False):
+        Car.add(make=u'savepoint', model=model, year=2017)
+        db.sess.add(Car(make=u'savepoint', model=model + u' 2', year=2017))
+        if fail:
+            raise ValueError('inner')
+
+    @transaction_ncm
+    def outer(rollback):
+        db.sess.add(Car(make=u'savepoint', model=u'outer', year=2017))
+        add_inner(u'kept')
+        try:
+            add_inner(u'rolled back', fail=True)
+        except ValueError:
+            pass
+        if rollback:
+            raise ValueError('outer')
+
+    # the inner transactions did not commit, so the outer one rolls back all
+    try:
+        outer(rollback=True)
+    except ValueError:
+        pass
+    eq_(Car.count_by(make=u'savepoint'), 0)
+
+    outer(rollback=False)
+    eq_(sorted(c.model for c in Car.list_by(make=u'savepoint')),
+        [u'kept', u'kept 2', u'outer'])
+    Car.delete_where(Car.make == u'savepoint')
+
+    # not nested, it commits
+    add_inner(u'alone')
+    db.sess.remove()
+    eq_(Car.count_by(make=u'savepoint'), 2)
+    Car.delete_where(Car.make == u'savepoint')
+
+
+def test_is_retryable_msg():
+    totest = {
+        'postgresql': [
+            (True, 'could not serialize access due to concurrent update'),
+            (True, 'deadlock detected'),
+            (False, 'relation "foo" does not exist'),
+        ],
+        'mssql': [
+            (True, 'Transaction (Process ID 54) was deadlocked on lock resources with another '
+                   'process and has been chosen as the deadlock victim. Rerun the transaction.'),
+            (False, 'Invalid object name \'foo\'.'),
+        ],
+        'mysql': [
+            (True, 'Deadlock found when trying to get lock; try restarting transaction'),
+            (True, 'Lock wait timeout exceeded; try restarting transaction'),
+        ],
+        'sqlite': [
+            (True, 'database is locked'),
+            (False, 'no such table: foo'),
+        ],
+    }
+
+    def check_func(dialect, msg, expect):
+        eq_(expect, _is_retryable_msg(dialect, msg))
+
+    for k, v in six.iteritems(totest):
+        for expect, msg in v:
+            yield check_func, k, msg, expect
+
+
+def test_is_retryable_exc():
+    assert is_retryable_exc(locked_error())
+    assert not is_retryable_exc(ValueError('database is locked'))
+    assert not is_retryable_exc(
+        sa.exc.IntegrityError('INSERT ...', {}, Exception('database is locked'))
+    )
+
+
 def test_one_to_none_ncm():
     a = OneToNone.add(u'a')
     OneToNone.add(u'b')
@@ -139,6 +287,137 @@ def test_from_dict():
     assert c.make == 'chevy'
 
 
+def test_from_dict_nested():
+    Comment.delete_all()
+    Blog.delete_all()
+    b = Blog.add(title=u'nested')
+    bid = b.id
+    kept = Comment.add(blog_ident=b.ident)
+    kept_id = kept.id
+    db.sess.expire_all()
+
+    b = Blog.get(bid)
+    b.comments
+    with recorded_statements() as statements:
+        # the comments with a pk are looked up in one query, the nested blog
+        # dict without a pk updates the current blog
+        b.from_dict({'comments': [
+            {'id': kept_id, 'blog': {'title': u'renamed'}},
+            {'id': 100000},
+            {},
+        ]})
+    eq_(len([st for st in statements if 'FROM comments' in st]), 1)
+    db.sess.commit()
+
+    db.sess.remove()
+    b = Blog.get(bid)
+    eq_(b.title, u'renamed')
+    ids = sorted(c.id for c in b.comments)
+    eq_(len(ids), 3)
+    eq_(ids[:2], [kept_id, 100000])
+
+    # a nested dict with a pk loads that record
+    other = Blog.add(title=u'other')
+    c = Comment.get(kept_id)
+    c.from_dict({'blog': {'id': other.id, 'title': u'other renamed'}})
+    db.sess.commit()
+    eq_(Comment.get(kept_id).blog_ident, other.ident)
+    eq_(Blog.get(other.id).title, u'other renamed')
+
+    @raises(Exception, 'Cannot send mixed')
+    def mixed():
+        b.from_dict({'comments': [{}, 1]})
+    mixed()
+    db.sess.rollback()
+
+
+def test_eager_load():
+    Comment.delete_all()
+    Blog.delete_all()
+    for title in (u'one', u'two', u'three'):
+        b = Blog.add(title=title)
+        Comment.add(blog_ident=b.ident)
+        Comment.add(blog_ident=b.ident)
+    bid = b.id
+
+    def statements(fn):
+        db.sess.remove()
+        with detect_nplusone(threshold=100) as stats:
+            for blog in tolist(fn()):
+                blog.comments
+        return stats.statements
+
+    # a lazy load for each blog's comments
+    eq_(statements(lambda: Blog.list()), 4)
+    eq_(statements(lambda: Blog.list(mm_load='comments')), 2)
+    eq_(statements(lambda: Blog.list_by(mm_load={'comments': 'joined'})), 1)
+    eq_(statements(lambda: Blog.list_by(title=u'one', mm_load='comments')), 2)
+    eq_(statements(lambda: Blog.list_where(Blog.title != u'x', mm_load=['comments'])), 2)
+    eq_(statements(lambda: Blog.first_where(Blog.title == u'two', mm_load='comments')), 2)
+    eq_(statements(lambda: Blog.get(bid, mm_load={'comments': 'subquery'})), 2)
+    eq_(statements(lambda: Blog.get_by(title=u'one', mm_load=saorm.joinedload('comments'))), 1)
+    eq_(statements(lambda: Blog.first_by(title=u'one', mm_load='comments')), 2)
+
+    # every relationship on a path is loaded
+    db.sess.remove()
+    comments = Comment.list(mm_load={'blog.comments': 'joined'})
+    with detect_nplusone(threshold=0) as stats:
+        [c.blog.comments for c in comments]
+    eq_(stats.statements, 0)
+
+    # the class default, which mm_load=() turns off
+    Blog.mm_eager_load = 'comments'
+    try:
+        eq_(statements(lambda: Blog.list_by()), 2)
+        eq_(statements(lambda: Blog.list_by(mm_load=())), 4)
+        eq_(statements(lambda: Blog.list(mm_load=())), 4)
+    finally:
+        del Blog.mm_eager_load
+
+    @raises(ValueError, 'eager load strategy must be one of')
+    def bad_strategy():
+        Blog.list(mm_load={'comments': 'eager'})
+    bad_strategy()
+
+
+def test_mapper_info():
+    info = Blog._sa_info()
+    assert Blog._sa_info() is info
+    eq_(info.pk_keys, ('id', ))
+    eq_(info.pk_cols, (Blog.__table__.c.id, ))
+    eq_(info.column_names, tuple(Blog.sa_column_names()))
+    eq_(info.relationships, {'comments': Comment})
+    eq_(Comment._sa_info().relationships, {'blog': Blog})
+    assert info.attr('title') is Blog.title
+    assert Car._sa_info() is not info
+
+
+def test_to_dicts():
+    Car.add(make=u'to_dicts', model=u'one', year=2001)
+    Car.add(make=u'to_dicts', model=u'two', year=2002)
+    cars = Car.list_by(make=u'to_dicts', order_by=Car.id)
+    expected = [c.to_dict() for c in cars]
+
+    eq_(Car.to_dicts(cars), expected)
+    eq_(Car.to_dicts(cars, exclude=('createdts', 'updatedts')),
+        [c.to_dict(exclude=('createdts', 'updatedts')) for c in cars])
+    eq_(Car.to_dicts(cars, exclude=[n for n in Car.sa_column_names() if n != 'model']),
+        [{'model': u'one'}, {'model': u'two'}])
+
+    # only columns are selected from a query
+    db.sess.expunge_all()
+    query = Car.query().filter_by(make=u'to_dicts').order_by(Car.id)
+    eq_(Car.to_dicts(query), expected)
+    eq_(len(db.sess.identity_map), 0)
+    eq_(Car.to_dicts(query, exclude=['id', 'createdts', 'updatedts', 'make']),
+        [{'model': u'one', 'year': 2001}, {'model': u'two', 'year': 2002}])
+
+    # the cached names can't be changed through sa_column_names()
+    Car.sa_column_names().append('foo')
+    assert 'foo' not in Car.sa_column_names()
+    Car.delete_where(Car.make == u'to_dicts')
+
+
 def test_get_by_and_where():
     Car.delete_all()
     Car.add(**{
@@ -156,6 +435,50 @@ def test_get_by_and_where():
     assert c is None
 
 
+def test_by_helpers_use_cached_statements():
+    Car.delete_all()
+    c1 = Car.add(make=u'chevy', model=u'astro', year=1993)
+    c2 = Car.add(make=u'chevy', model=u'cav', year=1993)
+    c3 = Car.add(make=u'ford', model=u'taurus', year=2010)
+
+    # the baked queries are compiled on a bakery miss only
+    Car._baked_filter_by({})._bakery.clear()
+    bakes = []
+    bake = baked.BakedQuery._bake
+
+    def counted_bake(bq, session):
+        bakes.append(bq)
+        return bake(bq, session)
+
+    baked.BakedQuery._bake = counted_bake
+    try:
+        assert Car.get_by(make=u'chevy', model=u'astro') is c1
+        assert Car.get_by(model=u'cav', make=u'chevy') is c2
+        assert Car.get_by(make=u'chevy', model=u'nothere') is None
+        eq_(len(bakes), 1)
+
+        assert Car.first_by(make=u'chevy') is c1
+        assert Car.first_by(make=u'ford') is c3
+        eq_(Car.list_by(year=1993), [c1, c2])
+        eq_(Car.list_by(year=2010), [c3])
+        eq_(Car.count_by(year=1993), 2)
+        eq_(Car.count_by(make=u'ford', year=1993), 0)
+        eq_(len(bakes), 5)
+    finally:
+        baked.BakedQuery._bake = bake
+
+    # None values are compared with IS NULL
+    eq_(Car.count_by(updatedts=None), 3)
+    eq_(Car.list_by(updatedts=None, year=2010), [c3])
+
+    try:
+        Car.get_by(year=1993)
+        assert False
+    except Exception as e:
+        if 'Multiple rows were found for one()' != str(e):
+            raise
+
+
 def test_is_unique_msg():
     totest = {
         'sqlite': [
@@ -388,7 +711,49 @@ def test_count_and_delete_all():
     assert Car.count() == 3
     assert Car.count_by(model=u'count') == 2
     assert Car.count_where(Car.model == u'count') == 2
+    assert Car.count_where(Car.model == u'count', Car.year == 2010) == 1
+    assert Car.count_by() == 3
+    eq_(Car.count_estimate(), 3)
     eq_(Car.delete_all(), 3)
+    assert Car.count() == 0
+
+
+def test_count_without_subquery():
+    Comment.delete_all()
+    Blog.delete_all()
+    b = Blog.add(title=u'count')
+    Comment.add(blog_ident=b.ident)
+    Comment.add(blog_ident=b.ident)
+    # refreshed after the commits, before recording
+    b.ident
+
+    with recorded_statements() as statements:
+        Car.count()
+        Car.count_by(model=u'count')
+        Car.count_where(Car.model == u'count')
+        # a relationship is not a column, so the query is not baked
+        eq_(Comment.count_by(blog=b), 2)
+
+    eq_(len(statements), 4)
+    for statement in statements:
+        assert statement.startswith('SELECT count(*)'), statement
+        assert statement.count('SELECT') == 1, statement
+
+
+def test_count_single_table_inheritance():
+    Vehicle.delete_all()
+    Vehicle.add(name=u'van')
+    Motorcycle.add(name=u'one')
+    Motorcycle.add(name=u'two')
+
+    eq_(Vehicle.count(), 3)
+    eq_(Motorcycle.count(), 2)
+    eq_(Motorcycle.count_by(name=u'one'), 1)
+    eq_(Motorcycle.count_by(name=u'van'), 0)
+    eq_(Motorcycle.count_where(Motorcycle.name != u'one'), 1)
+    eq_(Motorcycle.count_estimate(), 2)
+    eq_(Motorcycle.page_where(total=True).total, 2)
+    Vehicle.delete_all()
 
 
 def test_query_attribute():
@@ -540,6 +905,15 @@ def test_lists_pairs_firsts():
                              order_by=Car.year.desc())
     eq_([], result)
 
+    # existing results can still be paired
+    eq_(Car.pairs('model:year', _result=[c1]), [(u'count', 2008)])
+
+    try:
+        Car.pairs_where('model:year', Car.model == u'count', erroneous='foo')
+        assert False
+    except ValueError:
+        pass
+
     ###
     #   test firsts
     ###
@@ -570,6 +944,175 @@ def test_lists_pairs_firsts():
         pass
 
 
+def test_iter_helpers():
+    Car.delete_all()
+    for year in range(2000, 2005):
+        Car.add(make=u'test', model=u'iter', year=year)
+    Car.add(make=u'test', model=u'iter2', year=2010)
+
+    eq_(list(Car.iter_all(batch_size=2)), Car.list())
+    eq_(list(Car.iter_all(batch_size=3)), Car.list())
+    eq_(list(Car.iter_all(order_by=Car.year.desc(), batch_size=2)),
+        Car.list(order_by=Car.year.desc()))
+
+    eq_(list(Car.iter_by(model=u'iter', batch_size=2)), Car.list_by(model=u'iter'))
+    eq_(list(Car.iter_by(model=u'nothere', batch_size=2)), [])
+
+    result = list(Car.iter_where(Car.year > 2001, Car.model == u'iter', batch_size=1))
+    eq_([c.year for c in result], [2002, 2003, 2004])
+    result = list(Car.iter_where(Car.year > 2001, order_by=Car.year.desc(), batch_size=2))
+    eq_([c.year for c in result], [2010, 2004, 2003, 2002])
+
+    try:
+        Car.iter_where(Car.year > 2001, erroneous='foo')
+        assert False
+    except ValueError:
+        pass
+
+
+def test_paginate():
+    Car.delete_all()
+    for year in (2003, 2001, 2004, 2001, 2002):
+        Car.add(make=u'test', model=u'page', year=year)
+    Car.add(make=u'test', model=u'other', year=2000)
+
+    def all_pages(**kwargs):
+        pages = [Car.paginate(Car.model == u'page', **kwargs)]
+        while pages[-1].next_cursor:
+            pages.append(Car.paginate(Car.model == u'page', after=pages[-1].next_cursor,
+                                      **kwargs))
+        return pages
+
+    pages = all_pages(per_page=2)
+    eq_([len(page) for page in pages], [2, 2, 1])
+    eq_([page.has_next for page in pages], [True, True, False])
+    eq_([c for page in pages for c in page], Car.list_where(Car.model == u'page'))
+
+    # the primary key breaks the ties between the two 2001 cars
+    pages = all_pages(per_page=2, order_by=Car.year.desc())
+    eq_([c.year for page in pages for c in page], [2004, 2003, 2002, 2001, 2001])
+    pages = all_pages(per_page=3, order_by=[Car.year, Car.id.desc()])
+    expected = Car.list_where(Car.model == u'page', order_by=[Car.year, Car.id.desc()])
+    eq_([c for page in pages for c in page], expected)
+
+    # datetimes survive the cursor
+    pages = all_pages(per_page=1, order_by=Car.createdts)
+    eq_(len(pages), 5)
+
+    page = Car.paginate(per_page=10)
+    eq_(len(page), 6)
+    assert page.next_cursor is None
+
+    @raises(InvalidCursor)
+    def bad_cursor():
+        Car.paginate(Car.model == u'page', after='not a cursor')
+    bad_cursor()
+
+    @raises(InvalidCursor)
+    def other_ordering():
+        after = Car.paginate(per_page=1).next_cursor
+        Car.paginate(per_page=1, order_by=Car.year, after=after)
+    other_ordering()
+
+    @raises(ValueError)
+    def not_a_column():
+        Car.paginate(order_by='year')
+    not_a_column()
+
+
+def test_page_where():
+    Car.delete_all()
+    for year in range(2000, 2005):
+        Car.add(make=u'test', model=u'page', year=year)
+
+    page = Car.page_where(Car.model == u'page', per_page=2, order_by=Car.year)
+    eq_([c.year for c in page], [2000, 2001])
+    eq_((page.page, page.next_page, page.has_next), (1, 2, True))
+    eq_((page.total, page.pages), (None, None))
+
+    page = Car.page_where(Car.model == u'page', per_page=2, page=3, total=True)
+    eq_([c.year for c in page], [2004])
+    eq_((page.next_page, page.has_next), (None, False))
+    eq_((page.total, page.pages), (5, 3))
+
+    # a known total is not counted again
+    with detect_nplusone(threshold=1) as stats:
+        page = Car.page_where(per_page=2, page=2, total=5)
+    eq_(stats.statements, 1)
+    eq_((page.total, page.pages), (5, 3))
+
+    @raises(ValueError)
+    def bad_page():
+        Car.page_where(page=0)
+    bad_page()
+
+
+def test_pairs_select_columns_only():
+    Car.delete_all()
+    cid = Car.add(make=u'test', model=u'pairs', year=2008).id
+    db.sess.remove()
+
+    result = Car.pairs('id:year')
+    eq_(result, [(cid, 2008)])
+    assert type(result[0]) is tuple
+    eq_(Car.pairs_by('id:model', year=2008), [(cid, u'pairs')])
+    eq_(Car.pairs_where('id:make', Car.year == 2008), [(cid, u'test')])
+    # no instances were loaded
+    eq_(len(db.sess.identity_map), 0)
+
+
+def test_pairs_property_fields():
+    Car.delete_all()
+    cid = Car.add(make=u'test', model=u'pairs', year=2008).id
+    Car.add(make=u'other', model=u'pairs', year=2009)
+
+    # a plain @property can not be SELECTed, the instances are loaded instead
+    eq_(Car.pairs('id:title', order_by=Car.year)[0], (cid, u'test pairs'))
+    eq_(Car.pairs_by('title:year', make=u'test'), [(u'test pairs', 2008)])
+    eq_(Car.pairs_where('id:title', Car.year == 2008), [(cid, u'test pairs')])
+
+
+def test_pairs_relationship_fields():
+    Comment.delete_all()
+    Blog.delete_all()
+    b = Blog.add(title=u'pairs')
+    cid = Comment.add(blog_ident=b.ident).id
+    db.sess.remove()
+
+    result = Comment.pairs('id:blog')
+    eq_(len(result), 1)
+    eq_(result[0][0], cid)
+    assert isinstance(result[0][1], Blog)
+    eq_(result[0][1].title, u'pairs')
+    eq_([(c, blog.title) for c, blog in Comment.pairs_by('id:blog', id=cid)], [(cid, u'pairs')])
+
+
+def test_get_many():
+    Car.delete_all()
+    cids = [Car.add(make=u'test', model=u'many', year=year).id for year in (2001, 2002, 2003)]
+    db.sess.remove()
+    c1 = Car.get(cids[0])
+
+    with recorded_statements() as statements:
+        result = Car.get_many([cids[2], 99999, cids[0], cids[1], cids[2]])
+        eq_(len(statements), 1)
+        eq_([c.year if c else None for c in result], [2003, None, 2001, 2002, 2003])
+        # instances already loaded are reused
+        assert result[2] is c1
+        assert result[0] is result[4]
+
+        # everything is loaded now
+        del statements[:]
+        eq_(Car.get_many(cids), [result[2], result[3], result[0]])
+        eq_(statements, [])
+
+        db.sess.remove()
+        Car.get_many(cids + [99999], chunk_size=2)
+        eq_(len(statements), 2)
+
+    eq_(Car.get_many([]), [])
+
+
 def test_edit():
     Car.delete_all()
     c1 = Car.add(**{
@@ -596,6 +1139,152 @@ def test_edit():
         pass
 
 
+def test_add_many():
+    Car.delete_all()
+    rows = [
+        {'make': u'ford', 'model': u'f150', 'year': 2010},
+        {'make': u'ford', 'model': u'f250', 'year': 2011},
+        {'make': u'chevy', 'model': u'astro', 'year': 1993},
+    ]
+    eq_(Car.add_many(rows, chunk_size=2), 3)
+    eq_(Car.count(), 3)
+    # column defaults should be applied
+    assert Car.first().createdts is not None
+    # the given rows should not be altered
+    assert 'id' not in rows[0]
+
+    pks = Car.add_many(iter(rows), return_pks=True)
+    eq_(len(pks), 3)
+    eq_(Car.count(), 6)
+    eq_(Car.get(pks[1]).model, u'f250')
+    eq_(Car.get(pks[2]).make, u'chevy')
+
+    eq_(Car.add_many([]), 0)
+
+
+def test_edit_many_and_update_where():
+    Car.delete_all()
+    c1 = Car.add(make=u'test', model=u'count', year=2008)
+    c2 = Car.add(make=u'test', model=u'count', year=2009)
+    c3 = Car.add(make=u'test', model=u'count2', year=2010)
+
+    eq_(Car.update_where(Car.model == u'count', Car.make == u'test', year=2000), 2)
+    # instances in the session are synchronized
+    eq_(c1.year, 2000)
+    eq_(c2.year, 2000)
+    eq_(c3.year, 2010)
+    eq_(Car.count_where(Car.year == 2000), 2)
+
+    eq_(Car.update_where(Car.id.in_([c1.id, c3.id]), synchronize_session='fetch',
+                         make=u'ford'), 2)
+    eq_(c1.make, u'ford')
+    eq_(c2.make, u'test')
+
+    rows = [
+        {'id': c1.id, 'model': u'f150'},
+        {'id': c3.id, 'model': u'f250', 'year': 2012},
+    ]
+    eq_(Car.edit_many(rows, chunk_size=1), 2)
+    eq_(c1.model, u'f150')
+    eq_(c1.year, 2000)
+    eq_(c3.model, u'f250')
+    eq_(c3.year, 2012)
+    eq_(c2.model, u'count')
+    db.sess.remove()
+    eq_(Car.get(c3.id).model, u'f250')
+
+    try:
+        Car.edit_many([{'model': u'no-id'}])
+        assert False
+    except ValueError:
+        pass
+
+
+def skip_old_sqlite_upsert():
+    dbapi = db.engine.dialect.dbapi
+    if db.engine.dialect.name == 'sqlite' and dbapi.sqlite_version_info < (3, 24):
+        raise SkipTest('upsert requires SQLite 3.24 or later')
+
+
+def test_upsert():
+    skip_old_sqlite_upsert()
+    CT = CustomerType
+    CT.delete_all()
+    ct = CT.upsert('label', label=u'upsert-one', active_flag=False)
+    assert ct.id
+    eq_(ct.active_flag, False)
+
+    ct2 = CT.upsert('label', label=u'upsert-one', active_flag=True)
+    assert ct2 is ct
+    eq_(ct.active_flag, True)
+    eq_(CT.count(), 1)
+
+    rows = [
+        {'label': u'upsert-one', 'active_flag': False},
+        {'label': u'upsert-two', 'active_flag': True},
+        # a different set of keys gets its own statement
+        {'label': u'upsert-three'},
+    ]
+    eq_(CT.upsert_many('label', rows, chunk_size=2), 3)
+    eq_(CT.count(), 3)
+    eq_(ct.active_flag, False)
+    eq_(CT.get_by(label=u'upsert-three').active_flag, True)
+
+    # with only the conflict columns, existing rows are left alone
+    Truck.delete_all()
+    Truck.upsert(['make', 'model'], make=u'ford', model=u'f150')
+    t = Truck.upsert(['make', 'model'], make=u'ford', model=u'f150')
+    eq_(t.model, u'f150')
+    eq_(Truck.count(), 1)
+
+    CT.delete_all()
+
+
+def test_upsert_compile():
+    from sqlalchemy.dialects import mssql, postgresql
+    from sqlalchemybwc.lib.upsert import Upsert
+
+    table = CustomerType.__table__
+    stmt = Upsert(table, ['label'], ['active_flag']).values(label=u'a', active_flag=1)
+
+    sql = str(stmt.compile(dialect=postgresql.dialect()))
+    assert sql.startswith('INSERT INTO sabwp_customer_types'), sql
+    assert sql.endswith(
+        'ON CONFLICT (label) DO UPDATE SET active_flag = excluded.active_flag'
+    ), sql
+
+    sql = str(stmt.compile(dialect=mssql.dialect()))
+    assert sql.startswith('MERGE INTO sabwp_customer_types WITH (HOLDLOCK) AS target'), sql
+    assert 'ON target.label = source.label' in sql, sql
+    assert 'WHEN MATCHED THEN UPDATE SET target.active_flag = source.active_flag' in sql, sql
+    assert 'WHEN NOT MATCHED THEN INSERT (' in sql, sql
+
+    stmt = Upsert(table, ['label'], []).values(label=u'a')
+    sql = str(stmt.compile(dialect=postgresql.dialect()))
+    assert sql.endswith('ON CONFLICT (label) DO NOTHING'), sql
+    sql = str(stmt.compile(dialect=mssql.dialect()))
+    assert 'WHEN MATCHED' not in sql, sql
+
+
+def test_upsert_old_sqlite():
+    from sqlalchemy.dialects import sqlite
+    from sqlalchemybwc.lib.upsert import Upsert
+
+    def dialect(version):
+        dialect = sqlite.dialect()
+        dialect.dbapi = type('dbapi', (object, ), {'sqlite_version_info': version})
+        return dialect
+
+    stmt = Upsert(CustomerType.__table__, ['label'], []).values(label=u'a')
+    sql = str(stmt.compile(dialect=dialect((3, 24, 0))))
+    assert sql.endswith('ON CONFLICT (label) DO NOTHING'), sql
+
+    @raises(sa.exc.CompileError, 'upsert requires SQLite 3.24 or later, not 3.11.0')
+    def old():
+        stmt.compile(dialect=dialect((3, 11, 0)))
+    old()
+
+
 def test_update():
     Car.delete_all()
     c = Car.update(make=u'ford', year=2010, model=u'test')
@@ -638,6 +1327,91 @@ def test_lookup_object():
     assert not CT.add_iu(label=u'one')
 
 
+class TestLookupCache(object):
+
+    def setUp(self):
+        CachedCustomerType.delete_all()
+        self.recording = recorded_statements()
+        self.statements = self.recording.__enter__()
+
+    def tearDown(self):
+        self.recording.__exit__(None, None, None)
+
+    def test_cached_reads(self):
+        CT = CachedCustomerType
+        one_id = CT.add(label=u'one').id
+        two_id = CT.testing_create(u'two').id
+        three_id = CT.testing_create(u'three', False).id
+        db.sess.remove()
+
+        expect = [(one_id, u'one'), (two_id, u'two')]
+        eq_(CT.pairs_active(), expect)
+        del self.statements[:]
+
+        eq_(CT.pairs_active(), expect)
+        result = CT.list_active()
+        eq_([(o.id, o.label) for o in result], expect)
+        # instances come from the identity map when present
+        assert CT.list_active()[0] is result[0]
+        eq_(CT.get_by_label(u'three').id, three_id)
+        assert CT.get_by_label(u'four') is None
+        eq_(self.statements, [])
+
+        # the instances are persistent in the current session
+        result[0].label = u'uno'
+        db.sess.commit()
+        eq_(CT.get(one_id).label, u'uno')
+
+        # arguments bypass the cache
+        del self.statements[:]
+        eq_(CT.pairs_active(three_id), [(three_id, u'three'), (two_id, u'two'),
+                                        (one_id, u'uno')])
+        assert self.statements
+
+    def test_writes_invalidate(self):
+        CT = CachedCustomerType
+        one_id = CT.add(label=u'one').id
+        eq_(CT.pairs_active(), [(one_id, u'one')])
+        CT.edit(one_id, label=u'uno')
+        eq_(CT.pairs_active(), [(one_id, u'uno')])
+        CT.update_where(CT.id == one_id, active_flag=False)
+        eq_(CT.pairs_active(), [])
+        CT.delete_all()
+        assert CT.get_by_label(u'uno') is None
+
+    def test_cleared_after_commit(self):
+        CT = CachedCustomerType
+        one_id = CT.add(label=u'one').id
+        eq_(CT.pairs_active(), [(one_id, u'one')])
+        bumps = []
+        CT.lookup_cache_bump = classmethod(lambda cls: bumps.append(cls))
+
+        @transaction_ncm(savepoint=True)
+        def rename():
+            CT.edit(one_id, label=u'uno')
+            # the savepoint is released, not committed: still cached
+            eq_(bumps, [])
+            eq_(CT.pairs_active(), [(one_id, u'one')])
+        try:
+            rename()
+            eq_(bumps, [CT])
+            eq_(CT.pairs_active(), [(one_id, u'uno')])
+        finally:
+            del CT.lookup_cache_bump
+
+    def test_version_stamp(self):
+        CT = CachedCustomerType
+        one_id = CT.add(label=u'one').id
+        eq_(CT.pairs_active(), [(one_id, u'one')])
+        db.sess.execute(CT.__table__.delete())
+        eq_(CT.pairs_active(), [(one_id, u'one')])
+        CT.lookup_cache_version = classmethod(lambda cls: 2)
+        try:
+            eq_(CT.pairs_active(), [])
+        finally:
+            del CT.lookup_cache_version
+
+
 def test_sa_column_names():
     eq_(CustomerType.sa_column_names(), ['id', 'createdts', 'updatedts', 'active_flag', 'label'])
     eq_(Truck.sa_column_names(), ['id', 'createdts', 'updatedts', 'make', 'model'])
@@ -769,6 +1543,689 @@ class TestAssertRaisesDecorators(object):
         Comment.add(blog_ident='abcdefg')
 
 
+class TestInstrumentation(object):
+
+    def test_normalize_sql(self):
+        eq_(normalize_sql('SELECT a\n    FROM t\n   WHERE a IN (?, ?,?)'),
+            'SELECT a FROM t WHERE a IN (?)')
+        eq_(normalize_sql('WHERE a IN (%(a_1)s, %(a_2)s) AND b = %(b)s'),
+            'WHERE a IN (?) AND b = %(b)s')
+        eq_(normalize_sql('INSERT INTO t (a, b) VALUES (%s, %s)'),
+            'INSERT INTO t (a, b) VALUES (?)')
+        eq_(normalize_sql('SELECT count(*) FROM t WHERE a = :a'),
+            'SELECT count(*) FROM t WHERE a = :a')
+
+    def test_query_instrument(self):
+        instrument = QueryInstrument(db.engine, slowest_count=1)
+        try:
+            # nothing is recorded until started
+            Car.count()
+            eq_(instrument.current, None)
+
+            stats = instrument.start()
+            Car.count()
+            Car.list()
+            assert instrument.stop() is stats
+            eq_(stats.statements, 2)
+            assert stats.duration > 0
+            eq_(len(stats.slowest), 1)
+            eq_(stats.as_dict()['statements'], 2)
+
+            Car.count()
+            eq_(stats.statements, 2)
+        finally:
+            instrument.remove()
+
+    def test_rows_affected(self):
+        Car.add(make=u'affected', model=u'one', year=2001)
+        Car.add(make=u'affected', model=u'two', year=2001)
+        instrument = QueryInstrument(db.engine)
+        try:
+            stats = instrument.start()
+            Car.list_by(make=u'affected')
+            eq_(stats.rows_affected, 0)
+            eq_(Car.update_where(Car.make == u'affected', year=2002), 2)
+            eq_(stats.rows_affected, 2)
+            eq_(stats.as_dict()['rows_affected'], 2)
+            instrument.stop()
+        finally:
+            instrument.remove()
+            Car.delete_where(Car.make == u'affected')
+
+    def test_detect_nplusone(self):
+        makes = (u'ford', u'chevy', u'dodge')
+        with detect_nplusone(threshold=3) as stats:
+            for make in makes:
+                Car.first_by(make=make)
+            Car.count()
+        eq_(len(stats.repeated(2)), 1)
+        count, sql = stats.repeated(2)[0]
+        eq_(count, 3)
+        assert 'FROM sabwp_cars' in sql
+
+        try:
+            with detect_nplusone(threshold=2):
+                for make in makes:
+                    Car.first_by(make=make)
+            assert False, 'expected NPlusOneError'
+        except NPlusOneError as e:
+            eq_(e.threshold, 2)
+            eq_(e.repeated[0][0], 3)
+            assert 'statements executed more than 2 times' in str(e)
+
+
+class TestSlowQueryLog(object):
+
+    def test_callback(self):
+        slow = []
+        sql_log = SlowQueryLog(db.engine, 0, explain=True, callback=slow.append)
+        try:
+            Car.first_by(make=u'slowford')
+            Car.add(make=u'slowford', model=u'taurus', year=2010)
+        finally:
+            sql_log.remove()
+
+        select = slow[0]
+        assert 'FROM sabwp_cars' in select.sql
+        assert "'slowford'" in select.sql, select.sql
+        assert 'slowford' in select.parameters
+        assert select.duration >= 0
+        # sqlite's EXPLAIN QUERY PLAN
+        assert select.plan
+        # the calling code is kept, not SQLAlchemy's internals
+        eq_(select.stack[-1][2], 'first_by')
+        eq_(select.stack[-2][2], 'test_callback')
+        assert not [f for f in select.stack if '/sqlalchemy/' in f[0]]
+        assert 'slow query' in str(select)
+
+        insert = [s for s in slow if s.sql.startswith('INSERT')][0]
+        assert "'taurus'" in insert.sql, insert.sql
+        # only SELECTs are explained
+        eq_(insert.plan, None)
+
+    def test_explain_sql(self):
+        sql_log = SlowQueryLog(None, 0)
+        eq_(sql_log.explain_sql('postgresql', 'SELECT a FROM t'), 'EXPLAIN ANALYZE SELECT a FROM t')
+        eq_(sql_log.explain_sql('sqlite', 'SELECT a FROM t'), 'EXPLAIN QUERY PLAN SELECT a FROM t')
+        eq_(sql_log.explain_sql('postgresql', 'UPDATE t SET a = 1'), None)
+        eq_(sql_log.explain_sql('oracle', 'SELECT a FROM t'), None)
+        # not run again by ANALYZE
+        eq_(sql_log.explain_sql('postgresql', 'SELECT a FROM t FOR UPDATE'),
+            'EXPLAIN SELECT a FROM t FOR UPDATE')
+        eq_(sql_log.explain_sql('postgresql', 'SELECT a FROM t FOR NO KEY UPDATE NOWAIT'),
+            'EXPLAIN SELECT a FROM t FOR NO KEY UPDATE NOWAIT')
+        eq_(sql_log.explain_sql('postgresql', "SELECT nextval('t_id_seq')"),
+            "EXPLAIN SELECT nextval('t_id_seq')")
+
+    def test_explain_savepoint(self):
+        slow = []
+        sql_log = SlowQueryLog(db.engine, 0, explain=True, callback=slow.append)
+        sql_log.explain_savepoint_dialects = (db.engine.dialect.name, )
+        try:
+            Car.add(make=u'explainsp', model=u'one', year=2010)
+            Car.first_by(make=u'explainsp')
+        finally:
+            sql_log.remove()
+        plans = [s.plan for s in slow if s.plan is not None]
+        assert plans and 'EXPLAIN failed' not in str(plans), plans
+        # the transaction is still usable
+        Car.delete_where(Car.make == u'explainsp')
+        eq_(Car.count_by(make=u'explainsp'), 0)
+
+    def test_threshold(self):
+        slow = []
+        sql_log = SlowQueryLog(db.engine, 60, callback=slow.append)
+        try:
+            Car.count()
+        finally:
+            sql_log.remove()
+        eq_(slow, [])
+
+    def test_log_file(self):
+        log_file = Path(tempfile.mkdtemp()) / 'slow.log'
+        sql_log = SlowQueryLog(db.engine, 0, log_file=str(log_file))
+        try:
+            Car.count()
+        finally:
+            sql_log.remove()
+            handler = slow_query_log.handlers.pop()
+            handler.close()
+        with open(str(log_file)) as fh:
+            contents = fh.read()
+        assert 'slow query' in contents
+        assert 'SELECT count(*)' in contents
+
+
+class TestPool(object):
+
+    def sa_settings(self, **kwargs):
+        sa_settings = QuickSettings()
+        sa_settings.pool_size = None
+        sa_settings.pool_max_overflow = None
+        sa_settings.pool_timeout = None
+        sa_settings.pool_recycle = None
+        sa_settings.pool_stats = False
+        sa_settings.update(kwargs)
+        return sa_settings
+
+    def db_settings(self, url, **kwargs):
+        db_settings = QuickSettings()
+        db_settings.url = url
+        db_settings.update(kwargs)
+        return db_settings
+
+    def file_engine(self, **kwargs):
+        url = 'sqlite:///%s' % (Path(tempfile.mkdtemp()) / 'pool.db')
+        return sa.create_engine(url, poolclass=TimedQueuePool, **kwargs)
+
+    def test_pool_options(self):
+        eq_(pool_options(self.db_settings('sqlite://'), self.sa_settings()), {
+            'poolclass': sa.pool.StaticPool,
+            'connect_args': {'check_same_thread': False},
+        })
+        # SQLite files use a NullPool, so there is nothing to size
+        eq_(pool_options(self.db_settings('sqlite:///foo.db'), self.sa_settings(pool_size=5)), {})
+
+        sa_settings = self.sa_settings(pool_size=5, pool_max_overflow=2, pool_stats=True)
+        eq_(pool_options(self.db_settings('postgresql://localhost/foo'), sa_settings), {
+            'poolclass': TimedQueuePool,
+            'pool_size': 5,
+            'max_overflow': 2,
+        })
+        eq_(pool_options(self.db_settings('mysql://localhost/foo'), self.sa_settings()),
+            {'pool_recycle': 3600})
+
+        # settings.db wins
+        db_settings = self.db_settings('postgresql://localhost/foo', pool_size=10)
+        eq_(pool_options(db_settings, self.sa_settings(pool_size=5)), {})
+
+    def test_pool_stats(self):
+        engine = self.file_engine(pool_size=1, max_overflow=0, pool_timeout=0.01)
+        stats = PoolStats(engine)
+        conn = engine.connect()
+        eq_(stats.checked_out, 1)
+        try:
+            engine.connect()
+            assert False, 'expected TimeoutError'
+        except sa.exc.TimeoutError:
+            pass
+        conn.close()
+        engine.connect().close()
+
+        info = stats.as_dict()
+        eq_(info['pool'], 'TimedQueuePool')
+        eq_(info['size'], 1)
+        eq_(info['checked_out'], 0)
+        eq_(info['checkouts'], 2)
+        eq_(info['connects'], 1)
+        eq_(info['timeouts'], 1)
+        eq_(sum(count for _, count in info['latency_histogram']), 3)
+        assert info['latency_max'] >= 0.01
+        stats.remove()
+
+    def test_pre_ping(self):
+        engine = self.file_engine(pool_size=1)
+        add_pre_ping(engine)
+        stats = PoolStats(engine)
+        conn = engine.connect()
+        dbapi_conn = conn.connection.connection
+        conn.close()
+
+        # the DB server dropped the pooled connection
+        dbapi_conn.close()
+        eq_(engine.scalar('SELECT 1'), 1)
+        eq_(stats.connects, 2)
+
+    def test_fork_check(self):
+        engine = self.file_engine()
+        add_fork_check(engine)
+        stats = PoolStats(engine)
+        conn = engine.connect()
+        # as if the connection had been made by the parent process
+        conn.connection._connection_record.info['sqlalchemybwc.pid'] = -1
+        conn.close()
+
+        eq_(engine.scalar('SELECT 1'), 1)
+        eq_(stats.connects, 2)
+
+    def test_warm_up(self):
+        engine = self.file_engine(pool_size=3)
+        warm_up(engine, 2)
+        eq_(engine.pool.checkedin(), 2)
+        eq_(engine.pool.checkedout(), 0)
+
+    def test_container_engine(self):
+        if is_memory_sqlite(db.engine.url):
+            assert isinstance(db.engine.pool, sa.pool.StaticPool)
+        eq_(db.pool_stats, None)
+
+
+class TestRouting(object):
+
+    def replica_engine(self):
+        engine = sa.create_engine('sqlite://')
+        Car.__table__.create(engine)
+        return engine
+
+    def test_round_robin(self):
+        r1, r2 = sa.create_engine('sqlite://'), sa.create_engine('sqlite://')
+        replicas = ReplicaSet([r1, r2])
+        eq_([replicas.choose() for _ in range(3)], [r1, r2, r1])
+
+    def test_least_connections(self):
+        r1, r2 = sa.create_engine('sqlite://'), sa.create_engine('sqlite://')
+        replicas = ReplicaSet([r1, r2], 'least_connections')
+        conn = r1.connect()
+        assert replicas.choose() is r2
+        conn.close()
+        assert replicas.choose() is r1
+
+    @raises(ValueError)
+    def test_bad_strategy(self):
+        ReplicaSet([], 'random')
+
+    def test_routing_session(self):
+        replica = self.replica_engine()
+        sess = RoutingSession(bind=db.engine, replicas=ReplicaSet([replica]))
+        try:
+            select = Car.__table__.select()
+            assert sess.get_bind(clause=select) is replica
+
+            db.sess.add(Car(make=u'routing', model=u'primary', year=2010))
+            db.sess.commit()
+
+            # the replica has no cars
+            eq_(sess.query(Car).filter_by(make=u'routing').count(), 0)
+
+            # after a flush, reads see the session's writes on the primary
+            sess.add(Car(make=u'routing', model=u'flushed', year=2010))
+            sess.flush()
+            eq_(sess.query(Car).filter_by(make=u'routing').count(), 2)
+            assert sess.get_bind(clause=select) is db.engine
+        finally:
+            sess.rollback()
+            sess.close()
+            Car.delete_where(Car.make == u'routing')
+
+    def test_statements_stick_to_primary(self):
+        replica = self.replica_engine()
+        select = Car.__table__.select()
+        for clause in (
+            select.with_for_update(),
+            Car.__table__.delete(),
+            sa.text('UPDATE sabwp_cars SET year = 2010'),
+        ):
+            sess = RoutingSession(bind=db.engine, replicas=ReplicaSet([replica]))
+            assert sess.get_bind(clause=clause) is db.engine
+            # and the SELECTs after it
+            assert sess.get_bind(clause=select) is db.engine
+
+        sess = RoutingSession(bind=db.engine, replicas=ReplicaSet([replica]))
+        try:
+            sess.query(Car).filter_by(make=u'nothere').update({'year': 2010})
+            assert sess.get_bind(clause=select) is db.engine
+        finally:
+            sess.rollback()
+            sess.close()
+
+    def test_one_replica_per_session(self):
+        r1, r2 = self.replica_engine(), self.replica_engine()
+        replicas = ReplicaSet([r1, r2])
+        select = Car.__table__.select()
+        sess = RoutingSession(bind=db.engine, replicas=replicas)
+        eq_([sess.get_bind(clause=select) for _ in range(3)], [r1, r1, r1])
+        # the next session gets the next replica
+        sess = RoutingSession(bind=db.engine, replicas=replicas)
+        assert sess.get_bind(clause=select) is r2
+        use_primary(sess)
+        assert sess.get_bind(clause=select) is db.engine
+
+    def test_use_primary(self):
+        replica = self.replica_engine()
+        sess = RoutingSession(bind=db.engine, replicas=ReplicaSet([replica]))
+        use_primary(sess)
+        assert sess.get_bind(clause=Car.__table__.select()) is db.engine
+
+    def test_container(self):
+        db_settings = QuickSettings()
+        db_settings.url = 'sqlite://'
+        db_settings.replica_urls = ['sqlite://', 'sqlite://']
+        container = SQLAlchemyContainer(db_settings)
+        created = []
+        container.engine_setup.append(created.append)
+        eq_(len(container.replicas.engines), 2)
+        assert container.engine not in container.replicas.engines
+        # setup, like the instrumentation, runs for the replicas too
+        eq_(created, [container.engine] + container.replicas.engines)
+        assert isinstance(container.Session(), RoutingSession)
+        container.Session.remove()
+
+    def test_detect_nplusone_on_replicas(self):
+        replica = self.replica_engine()
+        sess = RoutingSession(bind=db.engine, replicas=ReplicaSet([replica]))
+        try:
+            with detect_nplusone(threshold=100, engine=[db.engine, replica]) as stats:
+                sess.query(Car).count()
+                sess.query(Car).count()
+            eq_(stats.statements, 2)
+        finally:
+            sess.close()
+
+
+class TestLazyContainer(object):
+
+    def container(self, url='sqlite://'):
+        db_settings = QuickSettings()
+        db_settings.url = url
+        return SQLAlchemyContainer(db_settings)
+
+    def test_engine_created_on_first_use(self):
+        container = self.container()
+        created = []
+        container.engine_setup.append(created.append)
+        eq_(container._engine, None)
+        eq_(container.timings, {})
+
+        sess = container.Session()
+        assert sess.bind is container.engine
+        eq_(created, [container.engine])
+        assert container.timings['engine'] >= 0
+
+        # only once
+        container.engine
+        eq_(len(created), 1)
+        container.Session.remove()
+
+    def test_no_url(self):
+        container = self.container(url=None)
+        eq_(container.engine, None)
+        eq_(container.replicas, None)
+        # nothing to remove, nothing gets created
+        container.remove_session()
+        eq_(container._sessions, {})
+
+    def test_after_fork(self):
+        container = self.container('sqlite:///%s' % (Path(tempfile.mkdtemp()) / 'fork.db'))
+        container.db_settings.poolclass = sa.pool.QueuePool
+        sess = container.Session()
+        parent_dbapi_conn = sess.connection().connection.connection
+        parent_pool = container.engine.pool
+
+        # as if used in a forked child
+        container._pid = -1
+        child_sess = container.Session()
+        assert child_sess is not sess
+        assert container.engine.pool is not parent_pool
+        assert parent_pool in container._parent_objects
+        assert child_sess.connection().connection.connection is not parent_dbapi_conn
+        # the parent's connection was left alone
+        eq_(parent_dbapi_conn.execute('SELECT 1').fetchone(), (1, ))
+        child_sess.close()
+        sess.close()
+
+    def test_after_fork_hook_warms_up(self):
+        container = self.container('sqlite:///%s' % (Path(tempfile.mkdtemp()) / 'fork.db'))
+        container.db_settings.poolclass = sa.pool.QueuePool
+        container.sa_settings = QuickSettings(container.sa_settings.todict())
+        container.sa_settings.pool_warm_up = 2
+        parent_pool = container.engine.pool
+
+        # as os.register_at_fork() calls it in a forked child
+        container._pid = -1
+        _after_fork_in_child()
+        assert container._engine.pool is not parent_pool
+        eq_(container._engine.pool.checkedin(), 2)
+
+    def test_sess_cached_per_thread(self):
+        container = self.container()
+        if container.use_split_sessions:
+            raise SkipTest('the session is only cached per request with split sessions')
+        assert container.sess is container.Session
+        assert container._local.sess is container.Session
+
+        # as if forked
+        container._pid = -1
+        container.after_fork()
+        assert not hasattr(container._local, 'sess')
+        assert container.sess is container.Session
+
+    def test_load_models(self):
+        container = self.container()
+        loaded = []
+        container.set_model_loader(lambda: loaded.append(True))
+        container.load_models()
+        container.load_models()
+        eq_(loaded, [True])
+        assert 'models' in container.timings
+
+    def test_load_models_waits_for_loader(self):
+        container = self.container()
+        started = threading.Event()
+        finish = threading.Event()
+        loaded = []
+
+        def loader():
+            started.set()
+            finish.wait(5)
+            loaded.append(True)
+        container.set_model_loader(loader)
+
+        first = threading.Thread(target=container.load_models)
+        first.start()
+        started.wait(5)
+        seen = []
+        second = threading.Thread(target=lambda: seen.append(container.load_models() or loaded[:]))
+        second.start()
+        second.join(0.1)
+        # still waiting on the first thread's loader
+        assert second.is_alive()
+        finish.set()
+        first.join()
+        second.join()
+        eq_(seen, [[True]])
+        eq_(loaded, [True])
+
+    def test_load_models_error(self):
+        container = self.container()
+        calls = []
+
+        def loader():
+            calls.append(True)
+            if len(calls) == 1:
+                raise ImportError('broken model')
+        container.set_model_loader(loader)
+
+        @raises(ImportError, 'broken model')
+        def first():
+            container.load_models()
+        first()
+        # not marked as loaded, so it is tried again
+        container.load_models()
+        container.load_models()
+        eq_(len(calls), 2)
+
+
+class TestAsyncContainer(object):
+
+    def setUp(self):
+        if asyncio is None:
+            raise SkipTest('asyncio is not available')
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.adb = AsyncContainer(db._current_obj(), max_workers=2)
+
+    def tearDown(self):
+        self.adb.shutdown()
+        asyncio.set_event_loop(None)
+        self.loop.close()
+        Car.delete_where(Car.make == u'async')
+
+    def test_run_outside_task(self):
+        acar = self.adb.model(Car)
+        run = self.loop.run_until_complete
+        before = run(acar.count())
+        run(self.adb.run(lambda: Car.add(make=u'async', model=u'one', year=2017).id))
+        eq_(run(acar.count()), before + 1)
+        eq_(Car.count_by(make=u'async'), 1)
+
+    def test_session_per_task(self):
+        sessions = {}
+
+        @asyncio.coroutine
+        def work(name):
+            for _ in range(3):
+                # bare yields, to run on Python 2 as well as 3
+                future = self.adb.run(lambda: db.sess())
+                while not future.done():
+                    yield
+                sessions.setdefault(name, []).append(future.result())
+
+        self.loop.run_until_complete(asyncio.gather(work('a'), work('b')))
+        eq_(len(set(sessions['a'])), 1)
+        eq_(len(set(sessions['b'])), 1)
+        assert sessions['a'][0] is not sessions['b'][0]
+        assert sessions['a'][0] is not db.sess()
+
+        # the sessions are removed when the tasks are done
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.adb.shutdown()
+        eq_(self.adb.Session.registry.registry, {})
+
+    def test_task_calls_serialized(self):
+        active = []
+        overlaps = []
+        lock = threading.Lock()
+
+        def use_session():
+            sess = db.sess()
+            with lock:
+                if sess in active:
+                    overlaps.append(sess)
+                active.append(sess)
+            time.sleep(0.05)
+            with lock:
+                active.remove(sess)
+            return sess
+
+        sessions = []
+
+        @asyncio.coroutine
+        def work():
+            future = asyncio.gather(self.adb.run(use_session), self.adb.run(use_session))
+            while not future.done():
+                yield
+            sessions.extend(future.result())
+
+        self.loop.run_until_complete(work())
+        assert sessions[0] is sessions[1]
+        eq_(overlaps, [])
+
+        # outside of a task, each call has its own session
+        sessions = self.loop.run_until_complete(
+            asyncio.gather(self.adb.run(use_session), self.adb.run(use_session))
+        )
+        assert sessions[0] is not sessions[1]
+        eq_(overlaps, [])
+
+    def test_transaction(self):
+        def add_cars(count, fail=False):
+            for _ in range(count):
+                db.sess.add(Car(make=u'async', model=u'transaction', year=2017))
+            if fail:
+                raise ValueError('fail')
+
+        run = self.loop.run_until_complete
+        run(self.adb.transaction(add_cars)(2))
+        eq_(Car.count_by(make=u'async'), 2)
+
+        try:
+            run(self.adb.transaction(add_cars)(2, fail=True))
+            assert False, 'expected ValueError'
+        except ValueError:
+            pass
+        eq_(Car.count_by(make=u'async'), 2)
+
+
+class TestParallel(object):
+
+    def test_results_in_order(self):
+        Car.add(make=u'parallel', model=u'one', year=2017)
+
+        def slow_count():
+            time.sleep(0.2)
+            return Car.count_by(make=u'parallel')
+
+        start = time.time()
+        results = db.parallel(
+            slow_count,
+            lambda: [c.model for c in Car.list_by(make=u'parallel')],
+            slow_count,
+        )
+        eq_(results, [1, [u'one'], 1])
+        if not shares_connection(db.engine):
+            # the sleeps overlapped
+            assert time.time() - start < 0.4
+        Car.delete_where(Car.make == u'parallel')
+
+    def test_shared_connection_runs_serially(self):
+        db_settings = QuickSettings()
+        db_settings.url = 'sqlite://'
+        container = SQLAlchemyContainer(db_settings)
+        # an in-memory SQLite DB gets a StaticPool, one connection for all threads
+        assert shares_connection(container.engine)
+        assert not shares_connection(sa.create_engine('sqlite://', poolclass=sa.pool.NullPool))
+        Car.__table__.create(container.engine)
+
+        db._push_object(container)
+        try:
+            sess = db.sess()
+            sess.add(Car(make=u'serial', model=u'pending', year=2017))
+            sess.flush()
+            results = container.parallel(
+                threading.current_thread,
+                lambda: db.sess() is sess,
+                lambda: Car.count_by(make=u'serial'),
+            )
+            eq_(results, [threading.current_thread(), True, 1])
+            # the uncommitted write was not rolled back
+            eq_(Car.count_by(make=u'serial'), 1)
+        finally:
+            container.Session.remove()
+            db._pop_object(container)
+
+    def test_default_max_workers(self):
+        path = Path(tempfile.mkdtemp()) / 'parallel.db'
+        db_settings = QuickSettings()
+        db_settings.url = 'sqlite:///%s' % path
+        db_settings.poolclass = sa.pool.QueuePool
+        db_settings.pool_size = 3
+        db_settings.max_overflow = 0
+        container = SQLAlchemyContainer(db_settings)
+        eq_(pool_capacity(container.engine), 3)
+
+        def current_thread():
+            time.sleep(0.05)
+            return threading.current_thread()
+        # one connection is left for the current thread
+        threads = container.parallel(*[current_thread for _ in range(6)])
+        eq_(len(set(threads)), 2)
+
+    def test_separate_sessions(self):
+        sessions = db.parallel(lambda: db.sess(), lambda: db.sess(), max_workers=2)
+        assert sessions[0] is not sessions[1]
+        assert db.sess() not in sessions
+
+    def test_max_workers(self):
+        threads = db.parallel(*[threading.current_thread for _ in range(4)], max_workers=1)
+        eq_(len(set(threads)), 1)
+
+    @raises(ValueError)
+    def test_exception(self):
+        def fail():
+            raise ValueError('parallel')
+        db.parallel(Car.count, fail)
+
+
 class TestTestingHelpers(object):
 
     def test_query_to_str_with_query(self):
@@ -17,6 +17,15 @@ class Index(View):
         return 'Index Page'
 
 
+class RepeatedQueries(View):
+    def default(self):
+        # the same SELECT executed once per make, like a lazy load in a loop
+        for make in (u'ford', u'chevy', u'dodge'):
+            Car.first_by(make=make)
+
+        return 'Repeated Queries'
+
+
 class BeakerTest(View):
     def default(self):
         # need to touch the session for testing beaker